@@ -14,89 +14,355 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import argparse
+import collections
 import glob
 import json
 import logging
+import numbers
 import os
+import socket
 import subprocess
 import sys
+import threading
+import time
 
 ignored_interfaces = ('sit', 'tunl', 'bonding_master', 'teql',
                       'ip6_vti', 'ip6tnl', 'bond', 'lo')
 post_up = "    post-up route add -net {net} netmask {mask} gw {gw} || true\n"
 pre_down = "    pre-down route del -net {net} netmask {mask} gw {gw} || true\n"
 
+ENI_PATH = '/etc/network/interfaces'
+ENI_D_PATH = ENI_PATH + '.d'
+NETWORKD_PATH = '/etc/systemd/network'
+NETWORKD_PREFIX = '50-ironic-'
+NETPLAN_PATH = '/etc/netplan/50-ironic.yaml'
+SYS_CLASS_NET = '/sys/class/net'
+
+NETWORK_TYPES = ('ipv4_dhcp', 'ipv4', 'ipv6')
+# The Linux bonding driver calls LACP 802.3ad.
+BOND_MODES = {'802.1ad': '802.3ad'}
+
 log = logging.getLogger("net_config")
 
 
 def _exists_debian_interface(name):
-    file_to_check = '/etc/network/interfaces.d/{name}.cfg'.format(name=name)
+    file_to_check = os.path.join(ENI_D_PATH, '{name}.cfg'.format(name=name))
     return os.path.exists(file_to_check)
 
 
-def write_debian_interfaces(interfaces, sys_interfaces):
-    eni_path = '/etc/network/interfaces'
-    eni_d_path = eni_path + '.d'
-    files_to_write = dict()
-    files_to_write[eni_path] = "auto lo\niface lo inet loopback\n"
-    files_to_write[eni_path] += "source /etc/network/interfaces.d/*.cfg\n"
+def _prefix_length(netmask):
+    if ':' in netmask:
+        packed = socket.inet_pton(socket.AF_INET6, netmask)
+    else:
+        packed = socket.inet_aton(netmask)
+    return sum(bin(octet).count('1') for octet in bytearray(packed))
+
+
+def _link_kind(link):
+    if 'vlan_id' in link:
+        return 'vlan'
+    if 'bond_links' in link:
+        return 'bond'
+    return 'phy'
 
-    for iname, interface in interfaces.items():
-        if (interface['mac_address'] not in sys_interfaces and
-                interface['link_mac'] not in sys_interfaces):
+
+def network_devices(interfaces, sys_interfaces):
+    """Resolve config drive interfaces to the devices configuring them.
+
+    Returns an OrderedDict of device dicts by name in which every device
+    comes after those it is built on: physical interfaces, then bonds,
+    then VLANs. Interfaces on hardware missing from sys_interfaces, and
+    those of an unknown network type, are left out.
+    """
+    phys = collections.OrderedDict()
+    bonds = collections.OrderedDict()
+    vlans = collections.OrderedDict()
+
+    def add_phy(link, master=None):
+        name = sys_interfaces.get(link.get('ethernet_mac_address'))
+        if name is None:
+            return None
+        device = phys.setdefault(name, {
+            'name': name, 'kind': 'phy',
+            'mac': link['ethernet_mac_address'], 'mtu': None,
+            'master': None, 'network': None})
+        device['mtu'] = device['mtu'] or link.get('mtu')
+        device['master'] = device['master'] or master
+        return name
+
+    # Bonds do not exist before they are configured, name them after the
+    # interfaces they bond so the names stay the same between runs.
+    bond_members = {}
+    for interface in interfaces.values():
+        for link in (interface, interface.get('raw_link')):
+            if link is None or _link_kind(link) != 'bond':
+                continue
+            members = [sys_interfaces[member['ethernet_mac_address']]
+                       for member in link.get('bond_members', [])
+                       if member.get('ethernet_mac_address') in
+                       sys_interfaces]
+            if members:
+                bond_members[link['id']] = members
+    ordered = sorted(bond_members,
+                     key=lambda link_id: sorted(bond_members[link_id]))
+    bond_names = dict((link_id, 'bond%d' % i)
+                      for i, link_id in enumerate(ordered))
+
+    def add_link(link):
+        if _link_kind(link) == 'phy':
+            return add_phy(link)
+        name = bond_names.get(link['id'])
+        if name is not None and name not in bonds:
+            for member in link['bond_members']:
+                add_phy(member, master=name)
+            mode = link.get('bond_mode')
+            bonds[name] = {
+                'name': name, 'kind': 'bond',
+                'mac': link.get('ethernet_mac_address'),
+                'mtu': link.get('mtu'),
+                'members': bond_members[link['id']],
+                'mode': BOND_MODES.get(mode, mode),
+                'xmit_hash_policy': link.get('bond_xmit_hash_policy'),
+                'miimon': link.get('bond_miimon'),
+                'network': None}
+        return name
+
+    for key in sorted(interfaces):
+        interface = interfaces[key]
+        if interface['type'] not in NETWORK_TYPES:
+            continue
+        if _link_kind(interface) != 'vlan':
+            name = add_link(interface)
+            if name is not None:
+                (phys.get(name) or bonds[name])['network'] = interface
             continue
+        raw_device = add_link(interface['raw_link'])
+        if raw_device is None:
+            continue
+        name = '{0}.{1}'.format(raw_device, interface['vlan_id'])
+        vlans[name] = {'name': name, 'kind': 'vlan', 'link': raw_device,
+                       'vlan_id': interface['vlan_id'],
+                       'mac': interface['mac_address'],
+                       'mtu': interface.get('mtu'), 'network': interface}
+
+    devices = collections.OrderedDict()
+    for group in (phys, bonds, vlans):
+        devices.update(group)
+    return devices
+
+
+def _eni_stanza(device):
+    network = device['network']
+    if network is None:
+        link_type, method = 'inet', 'manual'
+    elif network['type'] == 'ipv4_dhcp':
+        link_type, method = 'inet', 'dhcp'
+    elif network['type'] == 'ipv6':
+        link_type, method = 'inet6', 'static'
+    else:
+        link_type, method = 'inet', 'static'
 
-        if 'vlan_id' in interface:
-            vlan_raw_device = sys_interfaces[interface['link_mac']]
-            interface_name = "{0}.{1}".format(
-                vlan_raw_device,
-                interface['vlan_id'])
+    name = device['name']
+    result = "auto {0}\n".format(name)
+    result += "iface {name} {link_type} {method}\n".format(
+        name=name, link_type=link_type, method=method)
+    if device['kind'] == 'vlan':
+        result += "    vlan-raw-device {0}\n".format(device['link'])
+        if method == 'dhcp':
+            result += "    hw-mac-address {0}\n".format(device['mac'])
+    elif device['kind'] == 'bond':
+        result += "    bond-slaves {0}\n".format(' '.join(device['members']))
+        for option in ('mode', 'xmit_hash_policy', 'miimon'):
+            if device[option] is not None:
+                result += "    bond-{0} {1}\n".format(
+                    option.replace('_', '-'), device[option])
+    if device['mtu']:
+        result += "    mtu {0}\n".format(device['mtu'])
+    if method != 'static':
+        return result
+
+    result += "    address {0}\n".format(network['ip_address'])
+    result += "    netmask {0}\n".format(network['netmask'])
+    for route in network['routes']:
+        if route['network'] == '0.0.0.0' and route['netmask'] == '0.0.0.0':
+            result += "    gateway {0}\n".format(route['gateway'])
         else:
-            interface_name = sys_interfaces[interface['mac_address']]
+            result += post_up.format(
+                net=route['network'], mask=route['netmask'],
+                gw=route['gateway'])
+            result += pre_down.format(
+                net=route['network'], mask=route['netmask'],
+                gw=route['gateway'])
+    return result
 
-        if _exists_debian_interface(interface_name):
-            continue
 
-        iface_path = os.path.join(eni_d_path, '%s.cfg' % interface_name)
+def write_debian_interfaces(interfaces, sys_interfaces, skip_existing=True):
+    eni_path = ENI_PATH
+    eni_d_path = ENI_D_PATH
+    files_to_write = dict()
+    files_to_write[eni_path] = "auto lo\niface lo inet loopback\n"
+    files_to_write[eni_path] += "source /etc/network/interfaces.d/*.cfg\n"
 
-        if interface['type'] == 'ipv4_dhcp':
-            result = "auto {0}\n".format(interface_name)
-            result += "iface {0} inet dhcp\n".format(interface_name)
-            if vlan_raw_device is not None:
-                result += "    vlan-raw-device {0}\n".format(vlan_raw_device)
-                result += "    hw-mac-address {0}\n".format(
-                    interface['mac_address'])
-            files_to_write[iface_path] = result
+    for name, device in network_devices(interfaces, sys_interfaces).items():
+        # Bond slaves are brought up by their bond and take its MTU, and
+        # VLAN raw devices only need a stanza to set theirs.
+        needed = (device['network'] or device['mtu'] or
+                  device['kind'] == 'bond')
+        if device.get('master') or not needed:
             continue
-        if interface['type'] == 'ipv6':
-            link_type = "inet6"
-        elif interface['type'] == 'ipv4':
-            link_type = "inet"
-        # We do not know this type of entry
-        if not link_type:
+        if skip_existing and _exists_debian_interface(name):
             continue
+        iface_path = os.path.join(eni_d_path, '%s.cfg' % name)
+        files_to_write[iface_path] = _eni_stanza(device)
+    return files_to_write
+
 
-        result = "auto {0}\n".format(interface_name)
-        result += "iface {name} {link_type} static\n".format(
-            name=interface_name, link_type=link_type)
-        if vlan_raw_device:
-            result += "    vlan-raw-device {0}\n".format(vlan_raw_device)
-        result += "    address {0}\n".format(interface['ip_address'])
-        result += "    netmask {0}\n".format(interface['netmask'])
-        for route in interface['routes']:
-            if route['network'] == '0.0.0.0' and route['netmask'] == '0.0.0.0':
-                result += "    gateway {0}\n".format(route['gateway'])
+def _networkd_network(device, vlans):
+    lines = ['[Match]', 'Name={0}'.format(device['name'])]
+    if device['mtu']:
+        lines += ['', '[Link]', 'MTUBytes={0}'.format(device['mtu'])]
+    lines += ['', '[Network]']
+    if device.get('master'):
+        lines.append('Bond={0}'.format(device['master']))
+    lines.extend('VLAN={0}'.format(vlan) for vlan in vlans)
+
+    routes = []
+    network = device['network']
+    if network is not None and network['type'] == 'ipv4_dhcp':
+        lines.append('DHCP=ipv4')
+    elif network is not None:
+        lines.append('Address={0}/{1}'.format(
+            network['ip_address'], _prefix_length(network['netmask'])))
+        for route in network['routes']:
+            if _prefix_length(route['netmask']) == 0:
+                lines.append('Gateway={0}'.format(route['gateway']))
             else:
-                result += post_up.format(
-                    net=route['network'], mask=route['netmask'],
-                    gw=route['gateway'])
-                result += pre_down.format(
-                    net=route['network'], mask=route['netmask'],
-                    gw=route['gateway'])
-        files_to_write[iface_path] = result
+                routes.append(route)
+    for route in routes:
+        lines += ['', '[Route]',
+                  'Destination={0}/{1}'.format(
+                      route['network'], _prefix_length(route['netmask'])),
+                  'Gateway={0}'.format(route['gateway'])]
+    return '\n'.join(lines) + '\n'
+
+
+def _networkd_netdev(device):
+    kind = device['kind']
+    lines = ['[NetDev]', 'Name={0}'.format(device['name']),
+             'Kind={0}'.format(kind)]
+    if device['mac']:
+        lines.append('MACAddress={0}'.format(device['mac']))
+    if device['mtu']:
+        lines.append('MTUBytes={0}'.format(device['mtu']))
+    if kind == 'vlan':
+        lines += ['', '[VLAN]', 'Id={0}'.format(device['vlan_id'])]
+    else:
+        lines += ['', '[Bond]']
+        if device['mode'] is not None:
+            lines.append('Mode={0}'.format(device['mode']))
+        if device['xmit_hash_policy'] is not None:
+            lines.append('TransmitHashPolicy={0}'.format(
+                device['xmit_hash_policy']))
+        if device['miimon'] is not None:
+            lines.append('MIIMonitorSec={0}ms'.format(device['miimon']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_networkd_files(interfaces, sys_interfaces):
+    devices = network_devices(interfaces, sys_interfaces)
+    files_to_write = dict()
+    for name, device in devices.items():
+        path = os.path.join(NETWORKD_PATH, NETWORKD_PREFIX + name)
+        vlans = [vlan['name'] for vlan in devices.values()
+                 if vlan.get('link') == name]
+        files_to_write[path + '.network'] = _networkd_network(device, vlans)
+        if device['kind'] != 'phy':
+            files_to_write[path + '.netdev'] = _networkd_netdev(device)
     return files_to_write
 
 
+def _yaml_scalar(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, numbers.Integral):
+        return str(value)
+    if isinstance(value, dict):
+        return '{}'
+    if isinstance(value, list):
+        return '[]'
+    # JSON strings are valid YAML and never mistaken for another type.
+    return json.dumps(str(value))
+
+
+def _yaml(value, indent=0):
+    """Render nested dicts, lists and scalars as block style YAML lines."""
+    pad = '  ' * indent
+    lines = []
+    items = value.items() if isinstance(value, dict) else value
+    for item in items:
+        if isinstance(value, dict):
+            prefix, item = '{0}{1}:'.format(pad, item[0]), item[1]
+        else:
+            prefix = '{0}-'.format(pad)
+        if not isinstance(item, (dict, list)) or not item:
+            lines.append('{0} {1}'.format(prefix, _yaml_scalar(item)))
+        elif isinstance(value, dict):
+            lines.append(prefix)
+            lines.extend(_yaml(item, indent + 1))
+        else:
+            nested = _yaml(item, indent + 1)
+            lines.append('{0} {1}'.format(prefix, nested[0].lstrip()))
+            lines.extend(nested[1:])
+    return lines
+
+
+def write_netplan_config(interfaces, sys_interfaces):
+    sections = collections.OrderedDict([
+        ('phy', collections.OrderedDict()),
+        ('bond', collections.OrderedDict()),
+        ('vlan', collections.OrderedDict())])
+    for name, device in network_devices(interfaces, sys_interfaces).items():
+        entry = collections.OrderedDict()
+        if device['kind'] == 'bond':
+            entry['interfaces'] = device['members']
+            parameters = collections.OrderedDict()
+            for option, key in (('mode', 'mode'),
+                                ('xmit_hash_policy', 'transmit-hash-policy'),
+                                ('miimon', 'mii-monitor-interval')):
+                if device[option] is not None:
+                    parameters[key] = device[option]
+            entry['parameters'] = parameters
+        elif device['kind'] == 'vlan':
+            entry['id'] = device['vlan_id']
+            entry['link'] = device['link']
+        if device['kind'] != 'phy' and device['mac']:
+            entry['macaddress'] = device['mac']
+        if device['mtu']:
+            entry['mtu'] = device['mtu']
+
+        network = device['network']
+        if network is not None and network['type'] == 'ipv4_dhcp':
+            entry['dhcp4'] = True
+        elif network is not None:
+            entry['addresses'] = ['{0}/{1}'.format(
+                network['ip_address'], _prefix_length(network['netmask']))]
+            entry['routes'] = [collections.OrderedDict([
+                ('to', '{0}/{1}'.format(route['network'],
+                                        _prefix_length(route['netmask']))),
+                ('via', route['gateway'])]) for route in network['routes']]
+        sections[device['kind']][name] = entry
+
+    config = collections.OrderedDict([('version', 2),
+                                      ('renderer', 'networkd')])
+    for kind, section in (('phy', 'ethernets'), ('bond', 'bonds'),
+                          ('vlan', 'vlans')):
+        if sections[kind]:
+            config[section] = sections[kind]
+    content = '\n'.join(_yaml({'network': config})) + '\n'
+    return {NETPLAN_PATH: content}
+
+
 def get_config_drive_interfaces(net):
     interfaces = {}
 
@@ -119,11 +385,20 @@ def get_config_drive_interfaces(net):
         elif link['type'] == 'bond':
             bonds[link['id']] = link
 
-    for link in vlans.values():
-        if link['vlan_link'] in phys:
-            vlan_link = phys[link['vlan_link']]
-        elif link['vlan_link'] in bonds:
-            vlan_link = bonds[link['vlan_link']]
+    for link in bonds.values():
+        link['mac_address'] = link.get('ethernet_mac_address')
+        link['bond_members'] = [phys[member]
+                                for member in link.get('bond_links', [])
+                                if member in phys]
+
+    for link_id, link in list(vlans.items()):
+        vlan_link = phys.get(link['vlan_link'], bonds.get(link['vlan_link']))
+        if vlan_link is None:
+            log.warning("VLAN link %s is on unknown link %s", link_id,
+                        link['vlan_link'])
+            del vlans[link_id]
+            continue
+        link['raw_link'] = vlan_link
         link['link_mac'] = vlan_link['ethernet_mac_address']
         link['mac_address'] = link.get('vlan_mac_address',
                                        vlan_link['ethernet_mac_address'])
@@ -137,44 +412,433 @@ def get_config_drive_interfaces(net):
             continue
         link['type'] = network['type']
         link['network_id'] = network['network_id']
+        for key in ('ip_address', 'netmask'):
+            if key in network:
+                link[key] = network[key]
+        link['routes'] = network.get('routes', [])
         interfaces[i] = link
 
     return interfaces
 
 
-def get_sys_interfaces():
-    sys_root = os.path.join('/sys/class/net')
-    interfaces = [f for f in os.listdir(sys_root)
-                  if not f.startswith(ignored_interfaces)]
-    inter_map = {}
-    for interface in interfaces:
-        mac = open('%s/%s/address' % (sys_root, interface), 'r').read().strip()
-        inter_map[mac] = interface
-    return inter_map
+Interface = collections.namedtuple(
+    'Interface', ['name', 'mac', 'kind', 'parent', 'carrier', 'mtu'])
+
+# When interfaces share a MAC address, such as a VLAN and its raw device,
+# the MAC maps to the one of the kind listed first.
+_KIND_PRIORITY = ('phy', 'vf', 'bond', 'bridge', 'virtual', 'vlan')
+
+
+def _read_sys(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _list_dir(path):
+    """Return the names and paths of the entries of path."""
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        return [(name, os.path.join(path, name)) for name in os.listdir(path)]
+    return [(entry.name, entry.path) for entry in scandir(path)]
+
+
+def _describe_interface(name, path):
+    entries = set(entry for entry, _path in _list_dir(path))
+    uevent = _read_sys(os.path.join(path, 'uevent')) or ''
+    devtype = None
+    for line in uevent.splitlines():
+        if line.startswith('DEVTYPE='):
+            devtype = line[len('DEVTYPE='):]
+
+    parent = None
+    if devtype == 'vlan':
+        kind = 'vlan'
+        lowers = sorted(entry[len('lower_'):] for entry in entries
+                        if entry.startswith('lower_'))
+        parent = lowers[0] if lowers else None
+    elif devtype in ('bond', 'bridge'):
+        kind = devtype
+    elif 'device' in entries:
+        physfn = os.path.join(path, 'device', 'physfn')
+        kind = 'vf' if os.path.exists(physfn) else 'phy'
+    else:
+        kind = 'virtual'
+    if 'master' in entries:
+        parent = os.path.basename(
+            os.path.realpath(os.path.join(path, 'master')))
+
+    # Bond slaves take the address of their bond, their own is kept aside.
+    mac = (_read_sys(os.path.join(path, 'bonding_slave', 'perm_hwaddr')) or
+           _read_sys(os.path.join(path, 'address')))
+    carrier = _read_sys(os.path.join(path, 'carrier'))
+    mtu = _read_sys(os.path.join(path, 'mtu'))
+    return Interface(name=name, mac=mac, kind=kind, parent=parent,
+                     carrier=None if carrier is None else carrier == '1',
+                     mtu=int(mtu) if mtu else None)
+
+
+def discover_interfaces(sys_root=SYS_CLASS_NET):
+    """Describe every network interface found in sys_root.
+
+    Returns two dicts of Interface records, one by name and one by MAC
+    address.
+    """
+    by_name = {}
+    for name, path in _list_dir(sys_root):
+        if name.startswith(ignored_interfaces):
+            continue
+        by_name[name] = _describe_interface(name, path)
+
+    def priority(interface):
+        if interface.kind in _KIND_PRIORITY:
+            return _KIND_PRIORITY.index(interface.kind), interface.name
+        return len(_KIND_PRIORITY), interface.name
+
+    by_mac = {}
+    for interface in sorted(by_name.values(), key=priority):
+        if interface.mac:
+            by_mac.setdefault(interface.mac, interface)
+    return by_name, by_mac
+
+
+def get_sys_interfaces(sys_root=SYS_CLASS_NET):
+    _by_name, by_mac = discover_interfaces(sys_root)
+    return dict((mac, interface.name) for mac, interface in by_mac.items())
+
+
+def run_command(cmd, timeout=None):
+    """Run cmd, killing it once it has run for timeout seconds.
+
+    Returns the exit code of cmd, or None when it timed out.
+    """
+    proc = subprocess.Popen(cmd)
+    if timeout is None:
+        return proc.wait()
+    deadline = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            proc.kill()
+            proc.wait()
+            return None
+        time.sleep(0.1)
+    return proc.returncode
+
+
+def interface_graph(files):
+    """Map every interface configured in files to those it depends on.
+
+    A VLAN depends on its raw device and a bond on its slaves.
+    """
+    graph = {}
+    for content in files.values():
+        name = None
+        for line in content.splitlines():
+            words = line.split()
+            if len(words) < 2:
+                continue
+            if words[0] == 'iface':
+                name = words[1]
+                graph.setdefault(name, set())
+            elif name and words[0] == 'vlan-raw-device':
+                graph[name].add(words[1])
+            elif name and words[0] == 'bond-slaves' and words[1] != 'none':
+                graph[name].update(words[1:])
+    graph.pop('lo', None)
+    return graph
+
+
+def _with_dependants(graph, names):
+    """Return names and every interface depending on them, transitively."""
+    result = set(names)
+    grown = True
+    while grown:
+        grown = False
+        for name, depends in graph.items():
+            if name not in result and depends & result:
+                result.add(name)
+                grown = True
+    return result
+
+
+def _levels(graph, names):
+    """Order names so every interface comes after those it depends on.
+
+    Interfaces in the same level do not depend on each other.
+    """
+    remaining = set(names)
+    levels = []
+    while remaining:
+        level = sorted(name for name in remaining
+                       if not graph.get(name, set()) & remaining)
+        # Break dependency cycles rather than looping forever.
+        level = level or sorted(remaining)
+        levels.append(level)
+        remaining.difference_update(level)
+    return levels
+
+
+def _run_level(action, names, runner, timeout, workers, skip=()):
+    results = [None] * len(names)
+    slots = threading.Semaphore(workers)
+
+    def run(i, name):
+        with slots:
+            start = time.time()
+            if name in skip:
+                code = None
+            else:
+                code = runner(['sudo', action, name], timeout)
+            results[i] = {'interface': name,
+                          'action': action,
+                          'returncode': code,
+                          'timed_out': code is None and name not in skip,
+                          'skipped': name in skip,
+                          'duration': time.time() - start}
+
+    threads = [threading.Thread(target=run, args=(i, name))
+               for i, name in enumerate(names)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def bring_down(names, graph, runner=run_command, timeout=None, workers=1):
+    """ifdown names, dependent interfaces before what they depend on."""
+    report = []
+    for level in reversed(_levels(graph, names)):
+        report.extend(_run_level('ifdown', level, runner, timeout, workers))
+    return report
+
+
+def bring_up(names, graph, runner=run_command, timeout=None, workers=1):
+    """ifup names, running up to workers independent interfaces at once.
+
+    Interfaces depending on one that failed to come up are skipped.
+    Returns one result per interface.
+    """
+    report = []
+    failed = set()
+    for level in _levels(graph, names):
+        skip = set(name for name in level if graph.get(name, set()) & failed)
+        results = _run_level('ifup', level, runner, timeout, workers, skip)
+        failed.update(result['interface'] for result in results
+                      if result['returncode'] != 0)
+        report.extend(results)
+    return report
+
+
+def _log_report(report):
+    for result in report:
+        if result['returncode'] == 0:
+            log.debug("%(action)s %(interface)s took %(duration).2fs",
+                      result)
+        else:
+            log.warning("%(action)s %(interface)s failed: returncode "
+                        "%(returncode)s, timed out %(timed_out)s, skipped "
+                        "%(skipped)s", result)
+
+
+def restart_networking(files=None, runner=run_command, timeout=None,
+                       workers=1):
+    """Restart networking, every interface of files in turn if given.
+
+    Without files all interfaces are restarted at once through ifupdown,
+    each of ifdown and ifup then gets timeout seconds. Returns the
+    per-interface report, or None without files.
+    """
+    if files is None:
+        for action in ('ifdown', 'ifup'):
+            code = runner(['sudo', action, '--exclude=lo', '-a'], timeout)
+            if code != 0:
+                log.warning("%(action)s -a failed: returncode %(code)s",
+                            {'action': action, 'code': code})
+        return None
+    graph = interface_graph(files)
+    report = bring_down(graph, graph, runner, timeout, workers)
+    report.extend(bring_up(graph, graph, runner, timeout, workers))
+    _log_report(report)
+    return report
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _write_file(path, content):
+    """Replace path with content atomically."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(content)
+    os.rename(tmp_path, path)
+
+
+def _interface_name(path):
+    return os.path.basename(path)[:-len('.cfg')]
+
+
+def apply_debian_interfaces(files, runner=run_command, timeout=None,
+                            workers=1):
+    """Bring the files on disk in line with files, restarting what changed.
+
+    Only the interfaces whose configuration was added, changed or removed
+    are cycled, along with those depending on them, and nothing at all
+    when the configuration is unchanged.
+    Returns the per-interface report of the cycled interfaces, or None
+    when the main interfaces file changed and all of networking was
+    restarted at once.
+    """
+    changed = dict((path, content) for path, content in files.items()
+                   if _read_file(path) != content)
+    stale = dict((path, _read_file(path) or '')
+                 for path in glob.glob(os.path.join(ENI_D_PATH, '*.cfg'))
+                 if path not in files)
+    if not changed and not stale:
+        log.info("Network configuration is unchanged")
+        return []
+
+    if ENI_PATH in changed:
+        for path in stale:
+            os.remove(path)
+        for path, content in changed.items():
+            _write_file(path, content)
+        if workers > 1:
+            return restart_networking(files, runner, timeout, workers)
+        restart_networking(runner=runner, timeout=timeout)
+        return None
 
+    graph = interface_graph(stale)
+    graph.update(interface_graph(files))
+    # The VLANs on a changed raw device or bond go down with it.
+    removed = set(_interface_name(path) for path in stale)
+    affected = _with_dependants(
+        graph, removed | set(_interface_name(path) for path in changed))
+    existing = removed | set(_interface_name(path) for path in files
+                             if path != ENI_PATH and os.path.exists(path))
+    configured = set(_interface_name(path) for path in files
+                     if path != ENI_PATH)
+    report = bring_down(affected & existing, graph, runner, timeout, workers)
+    for path in stale:
+        os.remove(path)
+    for path, content in changed.items():
+        _write_file(path, content)
+    up = affected & configured
+    report.extend(bring_up(up, graph, runner, timeout, workers))
+    _log_report(report)
+    return report
 
-def restart_networking():
-    subprocess.call(['sudo', 'ifdown', '--exclude=lo', '-a'])
-    subprocess.call(['sudo', 'ifup', '--exclude=lo', '-a'])
 
+def _apply_files(files, pattern, command, runner, timeout, force):
+    changed = dict((path, content) for path, content in files.items()
+                   if _read_file(path) != content)
+    stale = [path for path in glob.glob(pattern) if path not in files]
+    if not (changed or stale or force):
+        log.info("Network configuration is unchanged")
+        return None
+    for path in stale:
+        os.remove(path)
+    for path, content in changed.items():
+        _write_file(path, content)
+    code = runner(['sudo'] + command, timeout)
+    if code != 0:
+        log.warning("%(cmd)s failed: returncode %(code)s",
+                    {'cmd': ' '.join(command), 'code': code})
+    return code
 
-def main():
-    files = glob.glob("/etc/network/interfaces.d/*")
-    cmd = ['sudo', 'rm', '-f', '/etc/network/interfaces']
-    cmd.extend(files)
-    subprocess.call(cmd)
+
+def apply_networkd_files(files, runner=run_command, timeout=None,
+                         force=False):
+    """Write the systemd-networkd files and restart it if any changed.
+
+    Returns the exit code of the restart, or None when nothing changed.
+    """
+    pattern = os.path.join(NETWORKD_PATH, NETWORKD_PREFIX + '*')
+    return _apply_files(files, pattern,
+                        ['systemctl', 'restart', 'systemd-networkd'],
+                        runner, timeout, force)
+
+
+def apply_netplan_config(files, runner=run_command, timeout=None,
+                         force=False):
+    """Write the netplan configuration and apply it if it changed.
+
+    Returns the exit code of netplan, or None when nothing changed.
+    """
+    return _apply_files(files, NETPLAN_PATH, ['netplan', 'apply'],
+                        runner, timeout, force)
+
+
+Renderer = collections.namedtuple('Renderer', ['render', 'apply'])
+
+# Renderers other than ENI, which main handles itself.
+RENDERERS = {
+    'networkd': Renderer(write_networkd_files, apply_networkd_files),
+    'netplan': Renderer(write_netplan_config, apply_netplan_config),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Configure networking from the config drive.')
+    parser.add_argument('--full', action='store_true',
+                        help='Rewrite every interface file and restart all '
+                             'interfaces, even when nothing changed.')
+    parser.add_argument('--renderer', default='eni',
+                        choices=['eni'] + sorted(RENDERERS),
+                        help='Network configuration system to render for.')
+    parser.add_argument('--sys-root', default=SYS_CLASS_NET,
+                        help='Directory network interfaces are discovered '
+                             'in.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of independent interfaces brought up '
+                             'at the same time.')
+    parser.add_argument('--timeout', type=float,
+                        help='Seconds a single interface may take to come '
+                             'up or down.')
+    args = parser.parse_args(argv)
+
+    if args.full and args.renderer == 'eni':
+        files = glob.glob(ENI_D_PATH + "/*")
+        cmd = ['sudo', 'rm', '-f', ENI_PATH]
+        cmd.extend(files)
+        subprocess.call(cmd)
 
     subprocess.call(['sudo', 'mkdir', '-p', '/mnt/config'])
     subprocess.call(['sudo', 'mount', '/dev/disk/by-label/config-2',
                      '/mnt/config'])
     data = json.load(open("/mnt/config/openstack/latest/network_data.json"))
     interfaces = get_config_drive_interfaces(data)
-    sys_interfaces = get_sys_interfaces()
+    sys_interfaces = get_sys_interfaces(args.sys_root)
+
+    if args.renderer in RENDERERS:
+        renderer = RENDERERS[args.renderer]
+        files = renderer.render(interfaces, sys_interfaces)
+        renderer.apply(files, timeout=args.timeout, force=args.full)
+        return
+
+    if not args.full:
+        files = write_debian_interfaces(interfaces, sys_interfaces,
+                                        skip_existing=False)
+        apply_debian_interfaces(files, timeout=args.timeout,
+                                workers=args.workers)
+        return
+
     files = write_debian_interfaces(interfaces, sys_interfaces)
     for k, v in files.items():
         with open(k, 'w') as outfile:
             outfile.write(v)
-    restart_networking()
+    if args.workers > 1:
+        restart_networking(files, timeout=args.timeout, workers=args.workers)
+    else:
+        restart_networking(timeout=args.timeout)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,131 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+
+from neutronclient.common import exceptions as neutron_exceptions
+from oslo_config import cfg
+
+from ironic.common import network as common_net
+from sam_ironic_contrib import metrics
+
+client_opts = [
+    cfg.IntOpt('neutron_client_pool_size',
+               default=8,
+               min=1,
+               help='Maximum number of idle neutron clients kept by the '
+                    'conductor for reuse.'),
+    cfg.IntOpt('neutron_client_max_age',
+               default=3600,
+               min=0,
+               help='Seconds after which a pooled neutron client is '
+                    'replaced by a new one. 0 keeps clients until their '
+                    'token is rejected.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(client_opts, group='sam_ironic_contrib')
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class NeutronClientPool(object):
+    """Thread-safe pool of authenticated neutron clients.
+
+    Reusing clients keeps their session, token and HTTP connections alive
+    between calls. A client whose token is rejected is replaced and the
+    call retried once.
+    """
+
+    def __init__(self, size, max_age, factory=None):
+        self.size = size
+        self.max_age = max_age
+        self.constructions = 0
+        self.reuses = 0
+        self._factory = factory or common_net.get_neutron_client
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+
+    def _build(self):
+        metrics.incr('neutron.client_constructions')
+        client = self._factory()
+        with self._lock:
+            self.constructions += 1
+        return client, time.time()
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                client, created = self._idle.pop()
+                if not self.max_age or time.time() - created < self.max_age:
+                    metrics.incr('neutron.client_reuses')
+                    self.reuses += 1
+                    return client, created
+        return self._build()
+
+    def _release(self, entry):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(entry)
+
+    def call(self, method, *args, **kwargs):
+        metrics.incr('neutron.%s' % method)
+        entry = self._acquire()
+        try:
+            result = getattr(entry[0], method)(*args, **kwargs)
+        except neutron_exceptions.Unauthorized:
+            # The token of the client has expired, replace the client.
+            entry = self._build()
+            result = getattr(entry[0], method)(*args, **kwargs)
+        except Exception:
+            self._release(entry)
+            raise
+        self._release(entry)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'constructions': self.constructions,
+                    'reuses': self.reuses,
+                    'idle': len(self._idle)}
+
+
+class PooledNeutronClient(object):
+    """Neutron client which borrows a pooled client for every call."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            return self._pool.call(name, *args, **kwargs)
+        return call
+
+
+def get_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            opts = CONF.sam_ironic_contrib
+            _POOL = NeutronClientPool(opts.neutron_client_pool_size,
+                                      opts.neutron_client_max_age)
+    return _POOL
+
+
+def get_neutron_client():
+    """Return a neutron client backed by the conductor wide pool."""
+    return PooledNeutronClient(get_pool())
@@ -0,0 +1,190 @@
+# Copyright 2016 Cisco Systems
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+import six
+
+from nova.i18n import _LW
+from sam_ironic_contrib import metrics
+
+LOG = logging.getLogger(__name__)
+
+cache_opts = [
+    cfg.StrOpt('configdrive_cache_dir',
+               help='Directory where generated config drives are cached, '
+                    'keyed on a hash of their content. Caching is disabled '
+                    'when this is not set. The random_seed of the metadata '
+                    'is not part of the key, so a cache hit reuses the '
+                    'random_seed of the drive built first. Cached drives, '
+                    'including their user_data and injected files, stay '
+                    'on disk after their instance is deleted until they '
+                    'are evicted by configdrive_cache_size_mb. The '
+                    'directory is created readable by its owner only.'),
+    cfg.IntOpt('configdrive_cache_size_mb',
+               default=1024,
+               min=1,
+               help='Maximum size of the config drive cache, the least '
+                    'recently used drives are evicted first.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(cache_opts, group='sam_ironic_contrib')
+
+_SUFFIX = '.drive'
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def _normalize(path, data):
+    # The random seed is regenerated for every drive, it must not be part
+    # of the key or no two drives would ever match.
+    if path.endswith('meta_data.json'):
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+        metadata = json.loads(data)
+        if isinstance(metadata, dict):
+            metadata.pop('random_seed', None)
+        data = json.dumps(metadata, sort_keys=True)
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    return data
+
+
+class ConfigDriveCache(object):
+    """Size bounded, content addressed cache of encoded config drives.
+
+    Every drive is a file in the cache directory named after the hash of
+    the metadata it was built from. Files are written atomically and the
+    least recently used ones are removed when the cache grows too large.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        # Drives hold user_data and injected files, keep them private.
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        os.chmod(path, 0o700)
+
+    def key(self, instance_md, *extra):
+        """Hash the content of the drive instance_md would produce.
+
+        extra holds any other value the encoded drive depends on, such as
+        its compression level.
+        """
+        digest = hashlib.sha256()
+        for value in extra:
+            digest.update(repr(value).encode('utf-8'))
+        for path, data in sorted(instance_md.metadata_for_config_drive()):
+            digest.update(path.encode('utf-8'))
+            digest.update(b'\0')
+            digest.update(_normalize(path, data))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + _SUFFIX)
+
+    def get(self, key):
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            data = None
+
+        metrics.incr('configdrive_cache.miss' if data is None
+                     else 'configdrive_cache.hit')
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += len(data)
+        return data
+
+    def put(self, key, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._file(key))
+        except (IOError, OSError) as e:
+            LOG.warning(_LW("Failed to cache config drive %(key)s: "
+                            "%(err)s"), {'key': key, 'err': e})
+            metrics.incr('swallowed_errors.configdrive_cache')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        for _mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': float(self.hits) / lookups if lookups else 0,
+                    'bytes_saved': self.bytes_saved}
+
+
+def get_cache():
+    """Return the process wide config drive cache, None when disabled."""
+    global _CACHE
+    opts = CONF.sam_ironic_contrib
+    if not opts.configdrive_cache_dir:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ConfigDriveCache(
+                opts.configdrive_cache_dir,
+                opts.configdrive_cache_size_mb * 1024 * 1024)
+    return _CACHE
@@ -12,26 +12,83 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from oslo_config import cfg
+from oslo_log import log as logging
+
 from ironic.common import exception
-from ironic.common import network as common_net
+from ironic.common.i18n import _
+from ironic.common.i18n import _LW
 from ironic.dhcp import neutron
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import metrics
 from sam_ironic_contrib import network_provider
+from sam_ironic_contrib import utils
+
+dhcp_opts = [
+    cfg.IntOpt('port_ip_cache_ttl',
+               default=0,
+               min=0,
+               help='Seconds the fixed IP of a neutron port is cached by '
+                    'the conductor. 0 disables the cache.'),
+    cfg.IntOpt('port_ip_cache_size',
+               default=4096,
+               min=1,
+               help='Maximum number of ports whose fixed IP is cached, the '
+                    'least recently used are evicted first.'),
+    cfg.IntOpt('dhcp_update_workers',
+               default=8,
+               min=1,
+               help='Maximum number of ports whose DHCP options are '
+                    'updated concurrently for a single node.'),
+    cfg.FloatOpt('dhcp_update_timeout',
+                 default=30.0,
+                 help='Seconds a single DHCP option update may take before '
+                      'it is treated as failed. 0 disables the timeout.'),
+    cfg.BoolOpt('dhcp_update_provisioning_only',
+                default=False,
+                help='Only update the DHCP options of the provisioning or '
+                     'cleaning VIFs of a node when it has any, leaving its '
+                     'tenant VIFs alone.'),
+    cfg.StrOpt('dhcp_update_failure_policy',
+               default='log',
+               choices=['ignore', 'log', 'raise'],
+               help='What to do when updating the DHCP options of some '
+                    'ports fails: ignore the failures, log them, or raise '
+                    'an error listing them.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(dhcp_opts, group='sam_ironic_contrib')
+LOG = logging.getLogger(__name__)
+
+_NETWORK_PROVIDER = network_provider.NetworkProvider()
+_PORT_IP_CACHE = None
 
 
-def _get_vifs(task):
+def _port_ip_cache():
+    global _PORT_IP_CACHE
+    if _PORT_IP_CACHE is None:
+        _PORT_IP_CACHE = utils.TTLCache(
+            max_size=CONF.sam_ironic_contrib.port_ip_cache_size)
+    return _PORT_IP_CACHE
+
+
+def _get_vifs(task, provisioning_only=False):
     all_vifs = []
     for port in task.ports:
-        vifs = port.extra.get('vif_port_ids', [])
-        for vif in vifs:
-            all_vifs.append(vif)
+        if not provisioning_only:
+            vifs = port.extra.get('vif_port_ids', [])
+            for vif in vifs:
+                all_vifs.append(vif)
         prov_vif = port.extra.get('vif_port_id')
         if prov_vif:
             all_vifs.append(prov_vif)
 
     for portgroup in task.portgroups:
-        vifs = portgroup.extra.get('vif_port_ids', [])
-        for vif in vifs:
-            all_vifs.append(vif)
+        if not provisioning_only:
+            vifs = portgroup.extra.get('vif_port_ids', [])
+            for vif in vifs:
+                all_vifs.append(vif)
         prov_vif = portgroup.extra.get('vif_port_id')
         if prov_vif:
             all_vifs.append(prov_vif)
@@ -41,36 +98,81 @@ def _get_vifs(task):
 class NeutronDHCPApi(neutron.NeutronDHCPApi):
     """API for communicating to neutron 2.x API."""
 
+    @metrics.timed('dhcp_provider.update_dhcp_opts')
     def update_dhcp_opts(self, task, options, vifs=None):
-        if vifs is None:
+        opts = CONF.sam_ironic_contrib
+        if vifs is None and opts.dhcp_update_provisioning_only:
+            vifs = _get_vifs(task, provisioning_only=True) or _get_vifs(task)
+        elif vifs is None:
             vifs = _get_vifs(task)
         if not vifs:
             raise exception.FailedToUpdateDHCPOptOnPort(
                 _("No VIFs found for node %(node)s when attempting "
                   "to update DHCP BOOT options.") %
                 {'node': task.node.uuid})
-        for vif in vifs:
-            try:
-                self.update_port_dhcp_opts(vif, options,
-                                           token=task.context.auth_token)
-            except Exception:
-                pass
 
+        client = clients.get_neutron_client()
+        body = {'port': {'extra_dhcp_opts': options}}
+
+        def update(vif):
+            client.update_port(vif, body)
+
+        executor = utils.get_executor(opts.executor, opts.dhcp_update_workers)
+        results = executor.map(update, vifs,
+                               timeout=opts.dhcp_update_timeout or None)
+        failed = [result for result in results if result.error is not None]
+        if not failed:
+            return
+        if opts.dhcp_update_failure_policy != 'raise':
+            metrics.incr('swallowed_errors.update_dhcp_opts', len(failed))
+        if opts.dhcp_update_failure_policy == 'ignore':
+            return
+
+        errors = ', '.join('%s (%s)' % (result.item, result.error)
+                           for result in failed)
+        if opts.dhcp_update_failure_policy == 'raise':
+            raise exception.FailedToUpdateDHCPOptOnPort(
+                _("Failed to update DHCP BOOT options of node %(node)s "
+                  "on ports: %(errors)s") %
+                {'node': task.node.uuid, 'errors': errors})
+        LOG.warning(_LW("Failed to update DHCP BOOT options of node "
+                        "%(node)s on ports: %(errors)s"),
+                    {'node': task.node.uuid, 'errors': errors})
+
+    @metrics.timed('dhcp_provider.get_ip_addresses')
     def get_ip_addresses(self, task):
         vifs = _get_vifs(task)
-        client = common_net.get_neutron_client()
-        ips = []
+        ttl = CONF.sam_ironic_contrib.port_ip_cache_ttl
+        cache = _port_ip_cache()
+        ip_map = {}
+        missing = []
         for vif in vifs:
-            n_port = client.show_port(vif).get('port')
-            fixed_ips = n_port.get('fixed_ips')
-            if fixed_ips:
-                ips.append(fixed_ips[0].get('ip_address', None))
-        return ips
+            ip = cache.get(vif) if ttl else None
+            if ip is None:
+                missing.append(vif)
+            else:
+                ip_map[vif] = ip
+
+        if missing:
+            client = clients.get_neutron_client()
+            chunk = CONF.sam_ironic_contrib.port_list_chunk_size
+            for i in range(0, len(missing), chunk):
+                n_ports = client.list_ports(id=missing[i:i + chunk])
+                for n_port in n_ports.get('ports', []):
+                    fixed_ips = n_port.get('fixed_ips')
+                    if not fixed_ips:
+                        continue
+                    ip = fixed_ips[0].get('ip_address', None)
+                    ip_map[n_port['id']] = ip
+                    if ttl and ip is not None:
+                        cache.set(n_port['id'], ip, ttl)
+
+        return [ip_map[vif] for vif in vifs if vif in ip_map]
 
+    @metrics.timed('dhcp_provider.create_cleaning_ports')
     def create_cleaning_ports(self, task):
-        net_provider = network_provider.NetworkProvider()
-        return net_provider.add_cleaning_network(task)
+        return _NETWORK_PROVIDER.add_cleaning_network(task)
 
+    @metrics.timed('dhcp_provider.delete_cleaning_ports')
     def delete_cleaning_ports(self, task):
-        net_provider = network_provider.NetworkProvider()
-        return net_provider.remove_cleaning_network(task)
+        return _NETWORK_PROVIDER.remove_cleaning_network(task)
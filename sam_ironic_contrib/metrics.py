@@ -0,0 +1,167 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import contextlib
+import functools
+import socket
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+metrics_opts = [
+    cfg.StrOpt('metrics_sink',
+               default='none',
+               choices=['none', 'log', 'statsd', 'memory'],
+               help='Where timings and counters of the sam_ironic_contrib '
+                    'drivers are sent: nowhere, to the log, to a statsd '
+                    'server over UDP or kept in memory.'),
+    cfg.StrOpt('metrics_statsd_host',
+               default='localhost',
+               help='Host of the statsd server used by the statsd sink.'),
+    cfg.IntOpt('metrics_statsd_port',
+               default=8125,
+               help='Port of the statsd server used by the statsd sink.'),
+    cfg.StrOpt('metrics_prefix',
+               default='sam_ironic_contrib',
+               help='Prefix of every metric name.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(metrics_opts, group='sam_ironic_contrib')
+LOG = logging.getLogger(__name__)
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, float('inf'))
+
+_SINK = None
+_SINK_LOCK = threading.Lock()
+
+
+class NoopSink(object):
+    """Drops every metric."""
+
+    def timing(self, name, ms):
+        pass
+
+    def incr(self, name, count=1):
+        pass
+
+
+class LogSink(object):
+    """Writes every metric as a debug log line."""
+
+    def timing(self, name, ms):
+        LOG.debug("metric %(name)s took %(ms).3fms", {'name': name, 'ms': ms})
+
+    def incr(self, name, count=1):
+        LOG.debug("metric %(name)s incremented by %(count)d",
+                  {'name': name, 'count': count})
+
+
+class StatsdSink(object):
+    """Sends every metric to a statsd server over UDP."""
+
+    def __init__(self, host, port):
+        self._address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line.encode('utf-8'), self._address)
+        except socket.error:
+            pass
+
+    def timing(self, name, ms):
+        self._send('%s:%f|ms' % (name, ms))
+
+    def incr(self, name, count=1):
+        self._send('%s:%d|c' % (name, count))
+
+
+class MemorySink(object):
+    """Keeps latency histograms and counters in memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def timing(self, name, ms):
+        with self._lock:
+            histogram = self.histograms.setdefault(name, [0] * len(BUCKETS))
+            histogram[bisect.bisect_left(BUCKETS, ms)] += 1
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+def get_sink():
+    global _SINK
+    with _SINK_LOCK:
+        if _SINK is None:
+            kind = CONF.sam_ironic_contrib.metrics_sink
+            if kind == 'log':
+                _SINK = LogSink()
+            elif kind == 'statsd':
+                _SINK = StatsdSink(CONF.sam_ironic_contrib.metrics_statsd_host,
+                                   CONF.sam_ironic_contrib.metrics_statsd_port)
+            elif kind == 'memory':
+                _SINK = MemorySink()
+            else:
+                _SINK = NoopSink()
+    return _SINK
+
+
+def set_sink(sink):
+    """Replace the sink metrics are sent to, None to reload it from CONF."""
+    global _SINK
+    with _SINK_LOCK:
+        _SINK = sink
+
+
+def _name(name):
+    return '%s.%s' % (CONF.sam_ironic_contrib.metrics_prefix, name)
+
+
+def incr(name, count=1):
+    get_sink().incr(_name(name), count)
+
+
+@contextlib.contextmanager
+def timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        get_sink().timing(_name(name), (time.time() - start) * 1000)
+
+
+def timed(name):
+    """Decorator recording the latency of every call to a function."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
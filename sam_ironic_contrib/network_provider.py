@@ -12,157 +12,406 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from neutronclient.common import exceptions as neutron_exceptions
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import timeutils
 
-from ironic.common import network as common_net
+from ironic.common.i18n import _LE
+from ironic.common.i18n import _LI
+from ironic.common.i18n import _LW
 from ironic.networks import base
-from ironic import objects
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import metrics
+from sam_ironic_contrib import port_pool
+from sam_ironic_contrib import utils
+
+network_opts = [
+    cfg.StrOpt('executor',
+               default='green',
+               choices=sorted(utils.EXECUTORS),
+               help='Kind of worker pool used to issue concurrent neutron '
+                    'requests, either green threads or native threads.'),
+    cfg.IntOpt('neutron_workers',
+               default=8,
+               min=1,
+               help='Maximum number of concurrent neutron requests issued '
+                    'for a single node.'),
+    cfg.IntOpt('neutron_retries',
+               default=2,
+               min=0,
+               help='Number of times a failed neutron request is retried.'),
+    cfg.FloatOpt('neutron_retry_interval',
+                 default=1.0,
+                 help='Seconds to wait before the first retry of a failed '
+                      'neutron request, doubled on every further retry.'),
+    cfg.BoolOpt('skip_unchanged_port_updates',
+                default=True,
+                help='Compare the binding of tenant ports with their known '
+                     'neutron state and only update the ports that differ.'),
+    cfg.IntOpt('port_state_cache_ttl',
+               default=0,
+               min=0,
+               help='Seconds the conductor remembers the neutron state of '
+                    'a port it has updated, used to skip unchanged port '
+                    'updates. Changes made to a cached port outside of '
+                    'this conductor are not noticed, nor fixed, until it '
+                    'expires. 0 disables the cache, the ports are always '
+                    'compared with a fresh list from neutron.'),
+    cfg.IntOpt('port_state_cache_size',
+               default=4096,
+               min=1,
+               help='Maximum number of ports whose neutron state is '
+                    'cached, the least recently used are evicted first.'),
+    cfg.BoolOpt('reconcile_cleaning_ports',
+                default=True,
+                help='Reuse the cleaning ports a previous attempt left on '
+                     'neutron for a node, only creating the missing ones '
+                     'and deleting those no longer needed.'),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(network_opts, group='sam_ironic_contrib')
 LOG = logging.getLogger(__name__)
 
+_PORT_STATE_CACHE = None
+
+
+def _port_state_cache():
+    global _PORT_STATE_CACHE
+    if _PORT_STATE_CACHE is None:
+        _PORT_STATE_CACHE = utils.TTLCache(
+            max_size=CONF.sam_ironic_contrib.port_state_cache_size)
+    return _PORT_STATE_CACHE
+
+
+def _binding(node, device_id, local_link_information):
+    """Build the neutron port attributes binding a port to node."""
+    return {
+        'device_owner': 'baremetal:none',
+        'device_id': device_id,
+        'admin_state_up': True,
+        'binding:vnic_type': 'baremetal',
+        'binding:host_id': node.uuid,
+        'binding:profile': {
+            'local_link_information': local_link_information,
+        },
+    }
+
+
+def _matches(current, desired):
+    """Whether every attribute in desired has the same value in current."""
+    for key, value in desired.items():
+        if isinstance(value, dict):
+            if not _matches(current.get(key) or {}, value):
+                return False
+        elif current.get(key) != value:
+            return False
+    return True
+
 
 class NetworkProvider(base.NetworkProvider):
 
+    @metrics.timed('network_provider.add_provisioning_network')
     def add_provisioning_network(self, task):
-        node = task.node
-        network_uuid = CONF.provisioning_network_uuid
-        client = common_net.get_neutron_client()
-
-        for port in task.ports:
-            body = {
-                'port': {
-                    'network_id': network_uuid,
-                    'mac_address': port.address,
-                    'device_owner': 'baremetal:none',
-                    'device_id': node.uuid,
-                    'admin_state_up': True,
-                    'binding:vnic_type': 'baremetal',
-                    'binding:host_id': node.uuid,
-                    'binding:profile': {
-                        'local_link_information': [
-                            port.local_link_connection
-                        ],
-                    },
-                }
-            }
-            por = client.create_port(body)
-            extra = dict(port.extra)
-            extra['vif_port_id'] = por['port']['id']
-            port.extra = extra
-            port.save()
-        task.ports = objects.Port.list_by_node_id(task.context, node.id)
-        return self._port_map(task)
+        return self._add_network(task, CONF.provisioning_network_uuid)
 
+    @metrics.timed('network_provider.remove_provisioning_network')
     def remove_provisioning_network(self, task):
-        client = common_net.get_neutron_client()
-        for port in task.ports:
-            try:
-                client.delete_port(port.extra['vif_port_id'])
-            except Exception:
-                pass
-            extra = dict(port.extra)
-            try:
-                del extra['vif_port_id']
-            except Exception:
-                pass
-            port.extra = extra
-            port.save()
-        task.ports = objects.Port.list_by_node_id(task.context, task.node.id)
-        return self._port_map(task)
+        return self._remove_network(task)
 
+    @metrics.timed('network_provider.configure_tenant_networks')
     def configure_tenant_networks(self, task):
         node = task.node
-        client = common_net.get_neutron_client()
+        client = clients.get_neutron_client()
+        watch = timeutils.StopWatch().start()
+
+        members = {}
+        for port in task.ports:
+            if port.portgroup_id is not None:
+                members.setdefault(port.portgroup_id, []).append(port)
+        group_time = watch.elapsed()
+
+        updates = []
         for portgroup in task.portgroups:
-            for vif in portgroup.extra.get('vif_port_ids', []):
-                lli = []
-                ports = objects.Port.list_by_portgroup_id(portgroup.id)
-                for port in ports:
-                    lli.append(port.local_link_connection)
-
-                body = {
-                    'port': {
-                        'device_owner': 'baremetal:none',
-                        'device_id': node.instance_uuid,
-                        'admin_state_up': True,
-                        'binding:vnic_type': 'baremetal',
-                        'binding:host_id': node.uuid,
-                        'binding:profile': {
-                            'local_link_information': lli,
-                        },
-                    }
-                }
-                client.update_port(vif, body)
+            vifs = portgroup.extra.get('vif_port_ids', [])
+            if not vifs:
+                continue
+            lli = [port.local_link_connection
+                   for port in members.get(portgroup.id, [])]
+            binding = _binding(node, node.instance_uuid, lli)
+            updates.extend((vif, binding) for vif in vifs)
         for port in task.ports:
-            if port.portgroup_id is None:
-                for vif in port.extra.get('vif_port_ids', []):
-                    body = {
-                        'port': {
-                            'device_owner': 'baremetal:none',
-                            'device_id': node.instance_uuid,
-                            'admin_state_up': True,
-                            'binding:vnic_type': 'baremetal',
-                            'binding:host_id': node.uuid,
-                            'binding:profile': {
-                                'local_link_information': [
-                                    port.local_link_connection
-                                ],
-                            },
-                        }
-                    }
-                    client.update_port(vif, body)
+            vifs = port.extra.get('vif_port_ids', [])
+            if port.portgroup_id is not None or not vifs:
+                continue
+            binding = _binding(node, node.instance_uuid,
+                               [port.local_link_connection])
+            updates.extend((vif, binding) for vif in vifs)
+        count = len(updates)
+        build_time = watch.elapsed() - group_time
+
+        if CONF.sam_ironic_contrib.skip_unchanged_port_updates:
+            updates = self._changed_updates(client, updates)
+        diff_time = watch.elapsed() - group_time - build_time
+
+        results = self._update_ports(client, updates)
+        neutron_time = watch.elapsed() - group_time - build_time - diff_time
+        LOG.debug("Configured %(count)d tenant VIFs of node %(node)s, "
+                  "%(updated)d needed updating. Grouping ports took "
+                  "%(group).3fs, building port bodies %(build).3fs, "
+                  "diffing against neutron %(diff).3fs and updating "
+                  "neutron %(neutron).3fs",
+                  {'count': count, 'updated': len(updates),
+                   'node': node.uuid, 'group': group_time,
+                   'build': build_time, 'diff': diff_time,
+                   'neutron': neutron_time})
+
+        errors = [result for result in results if result.error is not None]
+        for result in errors:
+            LOG.error(_LE("Failed to bind neutron port %(port)s to node "
+                          "%(node)s: %(err)s"),
+                      {'port': result.item[0], 'node': node.uuid,
+                       'err': result.error})
+        if errors:
+            raise errors[0].error
 
     def unconfigure_tenant_networks(self, task):
         pass
 
+    @metrics.timed('network_provider.add_cleaning_network')
     def add_cleaning_network(self, task):
+        return self._add_network(
+            task, CONF.neutron.cleaning_network_uuid,
+            reconcile=CONF.sam_ironic_contrib.reconcile_cleaning_ports)
+
+    @metrics.timed('network_provider.remove_cleaning_network')
+    def remove_cleaning_network(self, task):
+        return self._remove_network(task)
+
+    def _add_network(self, task, network_uuid, reconcile=False):
         node = task.node
-        network_uuid = CONF.neutron.cleaning_network_uuid
-        client = common_net.get_neutron_client()
+        client = clients.get_neutron_client()
 
+        existing = {}
+        if reconcile:
+            existing = self._reconcile_ports(client, task, network_uuid)
+
+        bodies = []
+        rebind = []
+        for port in task.ports:
+            binding = _binding(node, node.uuid, [port.local_link_connection])
+            n_port = existing.get(port.address)
+            if n_port is not None:
+                if not _matches(n_port, binding):
+                    rebind.append((n_port['id'], binding))
+                continue
+            binding['network_id'] = network_uuid
+            binding['mac_address'] = port.address
+            bodies.append(binding)
+        created = self._bind_pooled_ports(client, network_uuid, bodies)
+        created.update(self._create_ports(client, bodies))
+        created.update(existing)
+
+        if rebind:
+            for result in self._update_ports(client, rebind):
+                if result.error is not None:
+                    raise result.error
+
+        extras = {}
         for port in task.ports:
-            body = {
-                'port': {
-                    'network_id': network_uuid,
-                    'mac_address': port.address,
-                    'device_owner': 'baremetal:none',
-                    'device_id': node.uuid,
-                    'admin_state_up': True,
-                    'binding:vnic_type': 'baremetal',
-                    'binding:host_id': node.uuid,
-                    'binding:profile': {
-                        'local_link_information': [
-                            port.local_link_connection
-                        ],
-                    },
-                }
-            }
-            por = client.create_port(body)
             extra = dict(port.extra)
-            extra['vif_port_id'] = por['port']['id']
-            port.extra = extra
-            port.save()
-        task.ports = objects.Port.list_by_node_id(task.context, node.id)
+            extra['vif_port_id'] = created[port.address]['id']
+            extras[port.uuid] = extra
+        self._save_extras(task, extras)
         return self._port_map(task)
 
-    def remove_cleaning_network(self, task):
-        client = common_net.get_neutron_client()
-        for port in task.ports:
+    def _reconcile_ports(self, client, task, network_uuid):
+        """Find the node's ports left on network_uuid by earlier attempts.
+
+        Returns the reusable ones keyed by MAC address. Those that do not
+        belong to any of the node's ports are deleted.
+        """
+        n_ports = client.list_ports(device_id=task.node.uuid,
+                                    network_id=network_uuid)['ports']
+        wanted = set(port.address for port in task.ports)
+        existing = {}
+        stray = []
+        for n_port in n_ports:
+            mac = n_port['mac_address']
+            if mac in wanted and mac not in existing:
+                existing[mac] = n_port
+            else:
+                stray.append(n_port['id'])
+
+        if stray:
+            LOG.info(_LI("Deleting %(count)d stray ports of node %(node)s "
+                         "on network %(net)s"),
+                     {'count': len(stray), 'node': task.node.uuid,
+                      'net': network_uuid})
+            self._delete_ports(client, stray)
+        return existing
+
+    def _bind_pooled_ports(self, client, network_uuid, bodies):
+        """Use ports from the network's warm pool for some of bodies.
+
+        Returns the bound ports keyed by MAC address and removes their
+        bodies from bodies, leaving those still to be created.
+        """
+        pool = port_pool.get_pool(network_uuid)
+        if pool is None or not bodies:
+            return {}
+        pooled = pool.acquire(len(bodies))
+        if not pooled:
+            return {}
+
+        updates = []
+        for n_port, body in zip(pooled, bodies):
+            attributes = dict(body)
+            del attributes['network_id']
+            updates.append((n_port['id'], attributes))
+
+        bound = {}
+        unused = []
+        for n_port, body, result in zip(pooled, list(bodies),
+                                        self._update_ports(client, updates)):
+            if result.error is None:
+                bound[body['mac_address']] = result.value['port']
+                bodies.remove(body)
+            else:
+                LOG.warning(_LW("Failed to bind pooled port %(port)s, "
+                                "creating a new one instead: %(err)s"),
+                            {'port': n_port['id'], 'err': result.error})
+                unused.append(n_port)
+        pool.release(unused)
+        return bound
+
+    def _create_ports(self, client, bodies):
+        """Create neutron ports, returning them keyed by MAC address.
+
+        All the ports are requested in a single bulk call, if neutron
+        refuses the bulk request each port is created on its own.
+        """
+        if not bodies:
+            return {}
+        try:
+            created = client.create_port({'ports': bodies})['ports']
+        except Exception as e:
+            LOG.warning(_LW("Bulk creation of %(count)d neutron ports "
+                            "failed, falling back to creating them one "
+                            "at a time: %(err)s"),
+                        {'count': len(bodies), 'err': e})
+            metrics.incr('swallowed_errors.bulk_create_port')
+            created = [client.create_port({'port': body})['port']
+                       for body in bodies]
+        return dict((por['mac_address'], por) for por in created)
+
+    def _changed_updates(self, client, updates):
+        """Filter out the (port id, binding) updates neutron already has.
+
+        The ports are fetched with as few list calls as possible. When
+        port_state_cache_ttl is set, ports this conductor updated
+        recently are taken from its cache instead.
+        """
+        ttl = CONF.sam_ironic_contrib.port_state_cache_ttl
+        cache = _port_state_cache()
+        current = {}
+        missing = []
+        for port_id, _attributes in updates:
+            state = cache.get(port_id) if ttl else None
+            if state is None:
+                missing.append(port_id)
+            else:
+                current[port_id] = state
+
+        chunk = CONF.sam_ironic_contrib.port_list_chunk_size
+        for i in range(0, len(missing), chunk):
+            n_ports = client.list_ports(id=missing[i:i + chunk])
+            for n_port in n_ports.get('ports', []):
+                current[n_port['id']] = n_port
+
+        return [(port_id, binding) for port_id, binding in updates
+                if not _matches(current.get(port_id, {}), binding)]
+
+    def _update_ports(self, client, updates):
+        """Apply (port id, attributes) updates, remembering the results."""
+        ttl = CONF.sam_ironic_contrib.port_state_cache_ttl
+        cache = _port_state_cache()
+
+        def update(args):
+            port_id, attributes = args
             try:
-                client.delete_port(port.extra['vif_port_id'])
+                n_port = client.update_port(port_id, {'port': attributes})
             except Exception:
-                pass
+                cache.invalidate(port_id)
+                raise
+            if ttl:
+                cache.set(port_id, n_port['port'], ttl)
+            return n_port
+
+        return self._neutron_map(update, updates)
+
+    def _remove_network(self, task):
+        client = clients.get_neutron_client()
+        vifs = [port.extra['vif_port_id'] for port in task.ports
+                if port.extra.get('vif_port_id')]
+        results = self._delete_ports(client, vifs)
+        failed = set(result.item for result in results
+                     if result.error is not None)
+
+        extras = {}
+        for port in task.ports:
+            vif = port.extra.get('vif_port_id')
+            if vif is None or vif in failed:
+                continue
             extra = dict(port.extra)
+            del extra['vif_port_id']
+            extras[port.uuid] = extra
+        self._save_extras(task, extras)
+        return self._port_map(task)
+
+    def _delete_ports(self, client, port_ids):
+        """Delete neutron ports concurrently, returning a result per port.
+
+        Ports that neutron no longer knows about count as deleted, other
+        failures are retried and then logged.
+        """
+        def delete(port_id):
             try:
-                del extra['vif_port_id']
-            except Exception:
-                pass
+                client.delete_port(port_id)
+            except neutron_exceptions.PortNotFoundClient:
+                metrics.incr('swallowed_errors.port_not_found')
+
+        results = self._neutron_map(delete, port_ids)
+        for result in results:
+            if result.error is not None:
+                LOG.error(_LE("Failed to delete neutron port %(port)s: "
+                              "%(err)s"),
+                          {'port': result.item, 'err': result.error})
+        return results
+
+    def _save_extras(self, task, extras):
+        """Persist new extra dicts, keyed by port uuid, of the task's ports.
+
+        Only ports whose extra actually changes are written. The saved
+        objects refresh themselves, so task.ports is kept up to date
+        without reloading the node's ports from the database.
+        """
+        for port in task.ports:
+            extra = extras.get(port.uuid)
+            if extra is None or extra == port.extra:
+                continue
             port.extra = extra
+            metrics.incr('db.port_save')
             port.save()
-        task.ports = objects.Port.list_by_node_id(task.context, task.node.id)
-        return self._port_map(task)
+
+    def _neutron_map(self, func, items):
+        """Call func for every item concurrently, retrying failures."""
+        opts = CONF.sam_ironic_contrib
+        executor = utils.get_executor(opts.executor, opts.neutron_workers)
+        return utils.map_with_retries(
+            executor, func, items, retries=opts.neutron_retries,
+            interval=opts.neutron_retry_interval)
 
     def _port_map(self, task):
         ma = {}
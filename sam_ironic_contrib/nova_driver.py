@@ -14,25 +14,221 @@
 #    under the License.
 
 import base64
+import collections
+import functools
 import gzip
+import io
+import multiprocessing
 import shutil
 import tempfile
 
+from eventlet import tpool
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import excutils
 
 from nova.i18n import _LE
+from nova.i18n import _LW
 
 from nova.api.metadata import base as instance_metadata
 from nova.network.neutronv2 import api as neutron
 from nova.virt import configdrive
 from nova.virt.ironic import driver as ironic_driver
 from nova.virt import netutils
+from sam_ironic_contrib import configdrive_cache
+from sam_ironic_contrib import metrics
+from sam_ironic_contrib import utils
+from sam_ironic_contrib import vif_placement
 
 LOG = logging.getLogger(__name__)
 
+driver_opts = [
+    cfg.IntOpt('network_cache_ttl',
+               default=300,
+               min=0,
+               help='Seconds the segmentation id of a neutron network is '
+                    'cached by nova-compute. 0 disables the cache.'),
+    cfg.IntOpt('network_cache_size',
+               default=1024,
+               min=1,
+               help='Maximum number of networks whose segmentation id is '
+                    'cached, the least recently used are evicted first.'),
+    cfg.IntOpt('ironic_api_workers',
+               default=8,
+               min=1,
+               help='Maximum number of concurrent ironic API updates issued '
+                    'for a single node.'),
+    cfg.IntOpt('ironic_api_retries',
+               default=2,
+               min=0,
+               help='Number of times a failed ironic API update is '
+                    'retried.'),
+    cfg.FloatOpt('ironic_api_retry_interval',
+                 default=1.0,
+                 help='Seconds to wait before the first retry of a failed '
+                      'ironic API update, doubled on every further retry.'),
+    cfg.IntOpt('configdrive_compression_level',
+               default=9,
+               min=1,
+               max=9,
+               help='gzip compression level used for config drives, lower '
+                    'is faster but produces larger drives.'),
+    cfg.BoolOpt('configdrive_spool_compressed',
+                default=False,
+                help='Write the compressed config drive to a temporary file '
+                     'before encoding it, instead of encoding it as it is '
+                     'compressed.'),
+    cfg.IntOpt('configdrive_build_workers',
+               default=0,
+               min=0,
+               help='Number of config drives of a batch built at the same '
+                    'time. Their compression runs in native threads, '
+                    'where zlib releases the GIL. 0 builds one per CPU.'),
+    cfg.StrOpt('vif_placement',
+               default='round_robin',
+               choices=sorted(vif_placement.PLACEMENTS),
+               help='How the ports or portgroups new VIFs are plugged '
+                    'into are chosen: evenly (round_robin), by physical '
+                    'network and cabling (physnet), or always the same '
+                    'one for a given VIF (sticky).'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(driver_opts, group='sam_ironic_contrib')
+
+_MISSING = object()
+_NETWORK_CACHE = None
+
+
+def _network_cache():
+    global _NETWORK_CACHE
+    if _NETWORK_CACHE is None:
+        _NETWORK_CACHE = utils.TTLCache(
+            max_size=CONF.sam_ironic_contrib.network_cache_size)
+    return _NETWORK_CACHE
+
+
+def invalidate_network_cache(network_id=None):
+    """Forget the cached segmentation id of a network, or of all of them."""
+    _network_cache().invalidate(network_id)
+
+
+def network_cache_stats():
+    return _network_cache().stats()
+
+
+# A multiple of 3 so base64 encoded chunks can simply be concatenated.
+_ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+
+class _Base64Writer(object):
+    """Write-only file object which base64 encodes what is written to it."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pending = b''
+
+    def write(self, data):
+        data = self._pending + data
+        end = len(data) - len(data) % 3
+        if end:
+            self._chunks.append(base64.b64encode(data[:end]))
+        self._pending = data[end:]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._pending:
+            self._chunks.append(base64.b64encode(self._pending))
+            self._pending = b''
+
+    def pop(self):
+        """Return the encoded chunks written since the last pop."""
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _compress_and_encode(fileobj, compresslevel, spool=False):
+    """Gzip and base64 encode fileobj, yielding the encoded output in chunks.
+
+    Only a chunk of the input and of the output is held in memory at a
+    time, unless spool is set in which case the whole compressed drive is
+    first written to a temporary file.
+    """
+    read = functools.partial(fileobj.read, _ENCODE_CHUNK_SIZE)
+
+    if spool:
+        with tempfile.NamedTemporaryFile() as compressed:
+            with gzip.GzipFile(fileobj=compressed, mode='wb',
+                               compresslevel=compresslevel) as gzipped:
+                shutil.copyfileobj(fileobj, gzipped)
+            compressed.seek(0)
+            for chunk in iter(functools.partial(compressed.read,
+                                                _ENCODE_CHUNK_SIZE), b''):
+                yield base64.b64encode(chunk)
+        return
+
+    encoder = _Base64Writer()
+    with gzip.GzipFile(fileobj=encoder, mode='wb',
+                       compresslevel=compresslevel) as gzipped:
+        for chunk in iter(read, b''):
+            gzipped.write(chunk)
+            for encoded in encoder.pop():
+                yield encoded
+    encoder.close()
+    for encoded in encoder.pop():
+        yield encoded
+
+
+def _encode_configdrive(fileobj, compresslevel, spool=False):
+    # The chunks go straight into one growing buffer, which getvalue
+    # hands back without copying it again.
+    encoded = io.BytesIO()
+    for chunk in _compress_and_encode(fileobj, compresslevel, spool=spool):
+        encoded.write(chunk)
+    return encoded.getvalue()
+
+
+def _make_configdrive(instance_md, compresslevel, spool=False,
+                      offload=False):
+    """Build a config drive, returning it gzipped and base64 encoded.
+
+    With offload the compression runs in a native thread of eventlet's
+    pool, leaving the hub free for other green threads meanwhile.
+    """
+    with tempfile.NamedTemporaryFile() as uncompressed:
+        with configdrive.ConfigDriveBuilder(instance_md=instance_md) as cdb:
+            cdb.make_drive(uncompressed.name)
+        uncompressed.seek(0)
+        if offload:
+            return tpool.execute(_encode_configdrive, uncompressed,
+                                 compresslevel, spool)
+        return _encode_configdrive(uncompressed, compresslevel, spool)
+
+
+ConfigDriveRequest = collections.namedtuple(
+    'ConfigDriveRequest',
+    ['instance', 'node', 'network_info', 'extra_md', 'files'])
+ConfigDriveRequest.__new__.__defaults__ = (None, None)
+
+
+class NodeNetworkIndex(object):
+    """Lookup tables over the ports and portgroups of a node.
+
+    Maps VIF ids to the port or portgroup they are plugged into and
+    portgroup ids to their member ports.
+    """
+
+    def __init__(self, ports, portgroups):
+        self.by_vif = {}
+        self.members = {}
+        for port in ports:
+            if port.portgroup_id is not None:
+                self.members.setdefault(port.portgroup_id, []).append(port)
+        for obj in list(ports) + list(portgroups):
+            for vif in obj.extra.get('vif_port_ids', []):
+                self.by_vif[vif] = obj
 
 
 class DynamicNetworkIronicDriver(ironic_driver.IronicDriver):
@@ -41,46 +237,82 @@ class DynamicNetworkIronicDriver(ironic_driver.IronicDriver):
     def macs_for_instance(self, instance):
         return None
 
+    def _call_ironic(self, method, *args, **kwargs):
+        metrics.incr('ironic.%s' % method)
+        return self.ironicclient.call(method, *args, **kwargs)
+
+    @metrics.timed('nova_driver.plug_vifs')
     def _plug_vifs(self, node, instance, network_info):
-        ports = self.ironicclient.call("node.list_ports", node.uuid)
-        portgroups = self.ironicclient.call("node.list_portgroups", node.uuid)
+        ports = self._call_ironic("node.list_ports", node.uuid,
+                                  detail=True)
+        portgroups = self._call_ironic("node.list_portgroups",
+                                       node.uuid, detail=True)
+        if portgroups:
+            resource, targets = 'portgroup', portgroups
+        else:
+            resource, targets = 'port', ports
 
-        vid = 0
+        placement = vif_placement.get_placement(
+            CONF.sam_ironic_contrib.vif_placement)
+        index = NodeNetworkIndex(ports, portgroups)
+        assigned = dict((target.uuid,
+                         list(target.extra.get('vif_port_ids', [])))
+                        for target in targets)
+        plugged = set(vif for vifs in assigned.values() for vif in vifs)
+        changed = set()
         for vif in network_info:
-            if not portgroups:
-                port = ports[vid % len(ports)]
-                port = self.ironicclient.call("port.get", port.uuid)
-                port.extra['vif_port_ids'] = port.extra.get('vif_port_ids', [])
-                port.extra['vif_port_ids'].append(vif['id'])
+            if vif['id'] in plugged:
+                continue
+            target = placement.place(vif, targets, assigned, index)
+            assigned[target.uuid].append(vif['id'])
+            plugged.add(vif['id'])
+            changed.add(target.uuid)
+
+        updates = []
+        for target in targets:
+            if target.uuid in changed:
                 patch = [{'op': 'add', 'path': '/extra/vif_port_ids',
-                          'value': port.extra.get('vif_port_ids', [])}]
-                self.ironicclient.call("port.update", port.uuid, patch)
-            else:
-                portgroup = portgroups[vid % len(portgroups)]
-                portgroup.extra['vif_port_ids'] = (
-                    portgroup.extra.get('vif_port_ids', []))
-                portgroup.extra['vif_port_ids'].append(vif['id'])
-            vid += 1
-        for portgrp in portgroups:
-            patch = [{'op': 'add', 'path': '/extra/vif_port_ids',
-                      'value': portgrp.extra.get('vif_port_ids', [])}]
-            self.ironicclient.call("portgroup.update", portgrp.uuid, patch)
+                          'value': assigned[target.uuid]}]
+                updates.append((resource, target.uuid, patch))
+        self._update_resources(updates)
 
+    def _update_resources(self, updates):
+        """Apply (resource, uuid, patch) updates concurrently.
+
+        Failed updates are retried with backoff. Every final failure is
+        logged and the first one is raised once all the updates have
+        completed.
+        """
+        def update(args):
+            resource, uuid, patch = args
+            return self._call_ironic("%s.update" % resource, uuid, patch)
+
+        opts = CONF.sam_ironic_contrib
+        executor = utils.get_executor('green', opts.ironic_api_workers)
+        results = utils.map_with_retries(
+            executor, update, updates, retries=opts.ironic_api_retries,
+            interval=opts.ironic_api_retry_interval)
+        errors = [result for result in results if result.error is not None]
+        for result in errors:
+            LOG.error(_LE("Failed to update %(resource)s %(uuid)s: "
+                          "%(err)s"),
+                      {'resource': result.item[0], 'uuid': result.item[1],
+                       'err': result.error})
+        if errors:
+            raise errors[0].error
+
+    @metrics.timed('nova_driver.unplug_vifs')
     def _unplug_vifs(self, node, instance, network_info):
-        ports = self.ironicclient.call("node.list_ports", node.uuid)
-        portgroups = self.ironicclient.call("node.list_portgroups", node.uuid)
-        for port in ports:
-            patch = [{'op': 'remove', 'path': '/extra/vif_port_ids'}]
-            try:
-                self.ironicclient.call("port.update", port.uuid, patch)
-            except Exception:
-                pass
-        for portgrp in portgroups:
-            patch = [{'op': 'remove', 'path': '/extra/vif_port_ids'}]
-            try:
-                self.ironicclient.call("portgroup.update", portgrp.uuid, patch)
-            except Exception:
-                pass
+        ports = self._call_ironic("node.list_ports", node.uuid, detail=True)
+        portgroups = self._call_ironic("node.list_portgroups", node.uuid,
+                                       detail=True)
+        patch = [{'op': 'remove', 'path': '/extra/vif_port_ids'}]
+        updates = [('port', port.uuid, patch) for port in ports
+                   if port.extra.get('vif_port_ids')]
+        updates.extend(('portgroup', portgrp.uuid, patch)
+                       for portgrp in portgroups
+                       if portgrp.extra.get('vif_port_ids'))
+        self._update_resources(updates)
 
     def _objs_to_dicts(self, objs):
         dicts = []
@@ -88,82 +320,208 @@ class DynamicNetworkIronicDriver(ironic_driver.IronicDriver):
             dicts.append(obj.to_dict())
         return dicts
 
-    def _get_port_for_vif(self, ports, vif):
-        for port in ports:
-            if vif in port.extra['vif_port_ids']:
-                return port
-
-    def _generate_configdrive(self, instance, node, network_info,
-                              extra_md=None, files=None):
-        if not extra_md:
-            extra_md = {}
+    def _get_segmentation_ids(self, network_ids):
+        ttl = CONF.sam_ironic_contrib.network_cache_ttl
+        cache = _network_cache()
+        seg_ids = {}
+        missing = []
+        for network_id in set(network_ids):
+            seg_id = cache.get(network_id, _MISSING) if ttl else _MISSING
+            if seg_id is _MISSING:
+                missing.append(network_id)
+            else:
+                seg_ids[network_id] = seg_id
 
-        client = neutron.get_client(None, admin=True)
+        if missing:
+            client = neutron.get_client(None, admin=True)
+            chunk = CONF.sam_ironic_contrib.port_list_chunk_size
+            networks = []
+            for i in range(0, len(missing), chunk):
+                metrics.incr('neutron.list_networks')
+                networks.extend(client.list_networks(
+                    id=missing[i:i + chunk])['networks'])
+            for network in networks:
+                seg_id = network['provider:segmentation_id']
+                seg_ids[network['id']] = seg_id
+                if ttl:
+                    cache.set(network['id'], seg_id, ttl)
+        return seg_ids
 
+    def _network_metadata(self, network_info, seg_ids, ports, portgroups):
         # Get vlan to port map
-        net_vlan_map = {}
         port_vlan_map = {}
         for vif in network_info:
-            if vif['network']['id'] not in net_vlan_map:
-                network = client.show_network(vif['network']['id'])
-                net_vlan_map[vif['network']['id']] = (
-                    network['network']['provider:segmentation_id'])
-            port_vlan_map[vif['id']] = net_vlan_map[vif['network']['id']]
+            port_vlan_map[vif['id']] = seg_ids[vif['network']['id']]
 
         network_metadata = netutils.get_network_metadata(network_info)
-
-        ports = self.ironicclient.call("node.list_ports",
-                                       node.uuid, detail=True)
-        portgroups = self.ironicclient.call("node.list_portgroups", node.uuid)
-        all_ports = ports + portgroups
+        index = NodeNetworkIndex(ports, portgroups)
 
         for link in network_metadata['links']:
             link['type'] = 'vlan'
             link['vlan_mac_address'] = link['ethernet_mac_address']
             link['neutron_port_id'] = link['vif_id']
             link['vlan_id'] = port_vlan_map[link['vif_id']]
-            link['vlan_link'] = self._get_port_for_vif(
-                all_ports, link['vif_id']).uuid
+            link['vlan_link'] = index.by_vif[link['vif_id']].uuid
             del link['ethernet_mac_address']
             del link['vif_id']
 
+        bonded = [pg for pg in portgroups if pg.extra.get('vif_port_ids')]
+        bonded_ids = set(pg.id for pg in bonded)
         for port in ports:
-            if port.extra.get('vif_port_ids', []):
-                link = {'id': port.uuid, 'type': 'phy', 'mtu': 9000,
-                        'ethernet_mac_address': port.address}
-                network_metadata['links'].append(link)
-
-        for pg in portgroups:
-            ps = [port for port in ports if port.portgroup_id is pg.id]
-            link = {'id': pg.uuid, 'type': 'bond',
-                    'ethernet_mac_address': ports[0].address,
+            if not (port.extra.get('vif_port_ids') or
+                    port.portgroup_id in bonded_ids):
+                continue
+            link = {'id': port.uuid, 'type': 'phy', 'mtu': 9000,
+                    'ethernet_mac_address': port.address}
+            network_metadata['links'].append(link)
+
+        for pg in bonded:
+            members = index.members.get(pg.id, [])
+            address = getattr(pg, 'address', None)
+            if not members:
+                LOG.warning(_LW("Portgroup %s has VIFs but no member ports, "
+                                "its bond has no links"), pg.uuid)
+            elif not address:
+                address = members[0].address
+            link = {'id': pg.uuid, 'type': 'bond', 'mtu': 9000,
+                    'ethernet_mac_address': address,
                     'bond_mode': '802.1ad',
                     'bond_xmit_hash_policy': 'layer3+4',
-                    'bond_miimon': 100, 'bond_links': []}
-            for port in ps:
-                link['bond_links'].append(port.uuid)
+                    'bond_miimon': 100,
+                    'bond_links': [port.uuid for port in members]}
+            network_metadata['links'].append(link)
+        return network_metadata
 
+    def _instance_metadata(self, instance, network_metadata, extra_md=None,
+                           files=None):
+        files = list(files or [])
         files.append(('ironicnetworking', 'yes'.encode()))
-
-        i_meta = instance_metadata.InstanceMetadata(
-            instance, content=files, extra_md=extra_md,
+        return instance_metadata.InstanceMetadata(
+            instance, content=files, extra_md=extra_md or {},
             network_metadata=network_metadata)
 
-        with tempfile.NamedTemporaryFile() as uncompressed:
+    @metrics.timed('nova_driver.generate_configdrive')
+    def _generate_configdrive(self, instance, node, network_info,
+                              extra_md=None, files=None):
+        seg_ids = self._get_segmentation_ids(
+            [vif['network']['id'] for vif in network_info])
+        ports = self._call_ironic("node.list_ports",
+                                  node.uuid, detail=True)
+        portgroups = self._call_ironic("node.list_portgroups",
+                                       node.uuid, detail=True)
+        i_meta = self._instance_metadata(
+            instance,
+            self._network_metadata(network_info, seg_ids, ports, portgroups),
+            extra_md, files)
+
+        opts = CONF.sam_ironic_contrib
+        cache = configdrive_cache.get_cache()
+        if cache is not None:
+            key = cache.key(i_meta, opts.configdrive_compression_level)
+            cached = cache.get(key)
+            if cached is not None:
+                LOG.debug("Using cached config drive %s", key,
+                          instance=instance)
+                return cached
+
+        try:
+            encoded = _make_configdrive(
+                i_meta, opts.configdrive_compression_level,
+                opts.configdrive_spool_compressed)
+        except Exception as e:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_LE("Creating config drive failed with "
+                              "error: %s"), e, instance=instance)
+
+        if cache is not None:
+            cache.put(key, encoded)
+        return encoded
+
+    def _list_node_networks(self, node_uuids):
+        """Fetch the ports and portgroups of many nodes concurrently.
+
+        Returns one utils.Result per node uuid holding a (ports,
+        portgroups) tuple.
+        """
+        def fetch(node_uuid):
+            return (self._call_ironic("node.list_ports", node_uuid,
+                                      detail=True),
+                    self._call_ironic("node.list_portgroups", node_uuid,
+                                      detail=True))
+
+        opts = CONF.sam_ironic_contrib
+        executor = utils.get_executor('green', opts.ironic_api_workers)
+        return utils.map_with_retries(
+            executor, fetch, node_uuids, retries=opts.ironic_api_retries,
+            interval=opts.ironic_api_retry_interval)
+
+    @metrics.timed('nova_driver.generate_configdrives')
+    def generate_configdrives(self, requests):
+        """Generate the config drives of many nodes at once.
+
+        requests are ConfigDriveRequest tuples. The networks, ports and
+        portgroups of all the nodes are fetched up front, then the drives
+        are built concurrently and compressed in parallel native threads.
+        Returns one utils.Result per request holding its base64 encoded
+        drive.
+        """
+        requests = [ConfigDriveRequest(*request) for request in requests]
+        seg_ids = self._get_segmentation_ids(
+            [vif['network']['id']
+             for request in requests for vif in request.network_info])
+        node_uuids = sorted(set(request.node.uuid for request in requests))
+        node_networks = dict(
+            (result.item, result)
+            for result in self._list_node_networks(node_uuids))
+
+        opts = CONF.sam_ironic_contrib
+        cache = configdrive_cache.get_cache()
+        results = [None] * len(requests)
+        keys = {}
+        builds = []
+        for i, request in enumerate(requests):
+            fetched = node_networks[request.node.uuid]
+            if fetched.error is not None:
+                results[i] = utils.Result(request, None, fetched.error)
+                continue
+            # A node whose VIFs are not plugged, or on an unknown
+            # network, only fails its own drive.
+            cached = None
             try:
-                with configdrive.ConfigDriveBuilder(instance_md=i_meta) as cdb:
-                    cdb.make_drive(uncompressed.name)
+                i_meta = self._instance_metadata(
+                    request.instance,
+                    self._network_metadata(request.network_info, seg_ids,
+                                           *fetched.value),
+                    request.extra_md, request.files)
+                if cache is not None:
+                    keys[i] = cache.key(i_meta,
+                                        opts.configdrive_compression_level)
+                    cached = cache.get(keys[i])
             except Exception as e:
-                with excutils.save_and_reraise_exception():
-                    LOG.error(_LE("Creating config drive failed with "
-                                  "error: %s"), e, instance=instance)
-
-            with tempfile.NamedTemporaryFile() as compressed:
-                # compress config drive
-                with gzip.GzipFile(fileobj=compressed, mode='wb') as gzipped:
-                    uncompressed.seek(0)
-                    shutil.copyfileobj(uncompressed, gzipped)
-
-                # base64 encode config drive
-                compressed.seek(0)
-                return base64.b64encode(compressed.read())
+                LOG.error(_LE("Creating config drive failed with "
+                              "error: %s"), e, instance=request.instance)
+                results[i] = utils.Result(request, None, e)
+                continue
+            if cached is not None:
+                results[i] = utils.Result(request, cached, None)
+                continue
+            builds.append((i, i_meta))
+
+        make = functools.partial(
+            _make_configdrive,
+            compresslevel=opts.configdrive_compression_level,
+            spool=opts.configdrive_spool_compressed, offload=True)
+        executor = utils.get_executor(
+            'green',
+            opts.configdrive_build_workers or multiprocessing.cpu_count())
+        built = executor.map(make, [i_meta for _i, i_meta in builds])
+        for (i, _i_meta), result in zip(builds, built):
+            request = requests[i]
+            if result.error is not None:
+                LOG.error(_LE("Creating config drive failed with "
+                              "error: %s"), result.error,
+                          instance=request.instance)
+            elif cache is not None:
+                cache.put(keys[i], result.value)
+            results[i] = utils.Result(request, result.value, result.error)
+        return results
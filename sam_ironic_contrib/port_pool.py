@@ -0,0 +1,143 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from ironic.common.i18n import _LE
+from ironic.common.i18n import _LW
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import metrics
+
+pool_opts = [
+    cfg.IntOpt('port_pool_size',
+               default=0,
+               min=0,
+               help='Number of unbound neutron ports the conductor keeps '
+                    'ready on the provisioning and cleaning networks, so '
+                    'attaching a node only has to bind them. 0 disables '
+                    'the pool.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(pool_opts, group='sam_ironic_contrib')
+LOG = logging.getLogger(__name__)
+
+POOL_DEVICE_OWNER = 'baremetal:pool'
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class PortPool(object):
+    """Unbound neutron ports kept ready on a single network.
+
+    Pooled ports are owned by this conductor through their device_id, so
+    they are found again after a restart and never handed out by another
+    conductor. Taking ports out of the pool starts a background refill.
+    """
+
+    def __init__(self, network_id, size, owner):
+        self.network_id = network_id
+        self.size = size
+        self.owner = owner
+        self._lock = threading.Lock()
+        self._ports = None
+        self._refilling = False
+
+    def _client(self):
+        return clients.get_neutron_client()
+
+    def _load(self):
+        if self._ports is None:
+            n_ports = self._client().list_ports(
+                network_id=self.network_id, device_id=self.owner,
+                device_owner=POOL_DEVICE_OWNER)['ports']
+            self._ports = list(n_ports)
+
+    def acquire(self, count):
+        """Take up to count ports out of the pool.
+
+        When the pool cannot be listed from neutron no port is taken, the
+        caller creates all of them.
+        """
+        try:
+            with self._lock:
+                self._load()
+                ports = self._ports[:count]
+                del self._ports[:count]
+        except Exception as e:
+            LOG.warning(_LW("Failed to list the port pool of network "
+                            "%(net)s: %(err)s"),
+                        {'net': self.network_id, 'err': e})
+            metrics.incr('swallowed_errors.port_pool_load')
+            ports = []
+        metrics.incr('port_pool.acquired', len(ports))
+        metrics.incr('port_pool.missed', count - len(ports))
+        self.refill_async()
+        return ports
+
+    def release(self, ports):
+        """Give back ports acquired but not used, unchanged."""
+        with self._lock:
+            self._ports.extend(ports)
+
+    def refill_async(self):
+        with self._lock:
+            if self._refilling:
+                return
+            self._refilling = True
+        eventlet.spawn_n(self._refill)
+
+    def _refill(self):
+        try:
+            with self._lock:
+                self._load()
+                missing = self.size - len(self._ports)
+            if missing <= 0:
+                return
+            body = {
+                'network_id': self.network_id,
+                'device_owner': POOL_DEVICE_OWNER,
+                'device_id': self.owner,
+                'admin_state_up': False,
+            }
+            created = self._client().create_port(
+                {'ports': [dict(body) for _i in range(missing)]})['ports']
+            with self._lock:
+                self._ports.extend(created)
+        except Exception as e:
+            LOG.error(_LE("Failed to refill the port pool of network "
+                          "%(net)s: %(err)s"),
+                      {'net': self.network_id, 'err': e})
+            metrics.incr('swallowed_errors.port_pool_refill')
+        finally:
+            with self._lock:
+                self._refilling = False
+
+
+def get_pool(network_id):
+    """Return the port pool of network_id, None when pools are disabled."""
+    size = CONF.sam_ironic_contrib.port_pool_size
+    if not size or not network_id:
+        return None
+    with _POOLS_LOCK:
+        pool = _POOLS.get(network_id)
+        if pool is None:
+            pool = _POOLS[network_id] = PortPool(network_id, size, CONF.host)
+            pool.refill_async()
+    return pool
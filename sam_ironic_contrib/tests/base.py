@@ -0,0 +1,40 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+from oslotest import base
+
+from sam_ironic_contrib.tests import fakes
+
+CONF = cfg.CONF
+
+
+class TestCase(base.BaseTestCase):
+    """Test case with a clean configuration and call counters."""
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.cfg_fixture = self.useFixture(config_fixture.Config(CONF))
+        fakes.FakeDbPort.saves = 0
+
+    def config(self, group='sam_ironic_contrib', **kwargs):
+        self.cfg_fixture.config(group=group, **kwargs)
+
+    def patch(self, obj, name, *args, **kwargs):
+        """Patch obj.name for the rest of the test, returning the patch."""
+        patcher = mock.patch.object(obj, name, *args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
@@ -0,0 +1,384 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of the providers and the nova driver against fake backends.
+
+Every scenario is run for each combination of node size and concurrency,
+config drive scenarios also for each drive size, and reports the API
+calls it made, its wall time and its peak memory as JSON, so results can
+be compared across commits::
+
+    python -m sam_ironic_contrib.tests.benchmark --ports 1,8,64 \\
+        --vifs 1,16,256 --concurrency 1,8 --drive-sizes 1048576,67108864 \\
+        --output bench.json
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import resource
+import sys
+import time
+import uuid
+
+import eventlet
+import mock
+from oslo_config import cfg
+
+import net_config
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import dhcp_provider
+from sam_ironic_contrib import network_provider
+from sam_ironic_contrib import nova_driver
+from sam_ironic_contrib.tests import fakes
+from sam_ironic_contrib import utils
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+CONF = cfg.CONF
+
+PROVISIONING_NETWORK = str(uuid.uuid4())
+CLEANING_NETWORK = str(uuid.uuid4())
+
+
+def _override(name, value, group=None):
+    try:
+        CONF.set_override(name, value, group=group)
+    except (cfg.NoSuchOptError, cfg.NoSuchGroupError):
+        CONF.register_opt(cfg.StrOpt(name), group=group)
+        CONF.set_override(name, value, group=group)
+
+
+class Environment(object):
+    """Fake backends and the patches pointing the code at them."""
+
+    def __init__(self, latency, failure_rate, drive_size, batch_size):
+        self.drive_size = drive_size
+        self.batch_size = batch_size
+        self.neutron = fakes.FakeNeutronClient(
+            latency=latency, failure_rate=failure_rate)
+        self.ironic = fakes.FakeIronicClient(
+            latency=latency, failure_rate=failure_rate)
+        self.networks = [self.neutron.add_network(100 + i)
+                         for i in range(8)]
+        self.patches = [
+            mock.patch.object(clients, 'get_neutron_client',
+                              return_value=self.neutron),
+            mock.patch.object(nova_driver.neutron, 'get_client',
+                              return_value=self.neutron),
+            mock.patch.object(nova_driver.netutils, 'get_network_metadata',
+                              side_effect=fakes.network_metadata),
+            mock.patch.object(nova_driver.instance_metadata,
+                              'InstanceMetadata',
+                              fakes.FakeInstanceMetadata),
+            mock.patch.object(nova_driver.configdrive, 'ConfigDriveBuilder',
+                              fakes.config_drive_builder(
+                                  lambda: self.drive_size)),
+            mock.patch.object(net_config, '_exists_debian_interface',
+                              return_value=False),
+        ]
+
+    def __enter__(self):
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *args):
+        for patch in self.patches:
+            patch.stop()
+        return False
+
+    def calls(self):
+        calls = collections.Counter()
+        for method, count in self.neutron.calls.items():
+            calls['neutron.%s' % method] += count
+        for method, count in self.ironic.calls.items():
+            calls['ironic.%s' % method] += count
+        calls['db.port_save'] = fakes.FakeDbPort.saves
+        return dict(calls)
+
+    def reset(self):
+        self.neutron.reset_calls()
+        self.ironic.reset_calls()
+        fakes.FakeDbPort.saves = 0
+
+    def tenant_node(self, ports, vifs):
+        task = fakes.make_node(ports, vifs=vifs)
+        for obj in task.ports:
+            for vif in obj.extra.get('vif_port_ids', []):
+                self.neutron.add_port(vif, mac_address=obj.address)
+        return task
+
+    def network_info(self, vifs):
+        return [{'id': str(uuid.uuid4()),
+                 'network': {'id': self.networks[i % len(self.networks)]}}
+                for i in range(vifs)]
+
+
+def network_provider_cycle(env, ports, vifs):
+    task = env.tenant_node(ports, vifs)
+    provider = network_provider.NetworkProvider()
+
+    def run():
+        provider.add_cleaning_network(task)
+        provider.remove_cleaning_network(task)
+        provider.add_provisioning_network(task)
+        provider.configure_tenant_networks(task)
+        provider.remove_provisioning_network(task)
+    return run
+
+
+def dhcp_provider_cycle(env, ports, vifs):
+    task = env.tenant_node(ports, vifs)
+    api = dhcp_provider.NeutronDHCPApi()
+    options = [{'opt_name': 'bootfile-name', 'opt_value': 'pxelinux.0'}]
+
+    def run():
+        api.update_dhcp_opts(task, options)
+        api.get_ip_addresses(task)
+    return run
+
+
+def plug_vifs(env, ports, vifs):
+    task = fakes.make_node(ports)
+    env.ironic.add_node(task.node.uuid, task.ports)
+    driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+    driver.ironicclient = env.ironic
+    network_info = env.network_info(vifs)
+
+    def run():
+        driver._plug_vifs(task.node, None, network_info)
+    return run
+
+
+def network_metadata(env, ports, vifs):
+    task = fakes.make_node(ports, portgroups=max(ports // 2, 1), vifs=vifs)
+    driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+    network_info = [{'id': vif, 'network': {'id': env.networks[0]}}
+                    for pg in task.portgroups
+                    for vif in pg.extra.get('vif_port_ids', [])]
+    seg_ids = {env.networks[0]: 100}
+
+    def run():
+        driver._network_metadata(network_info, seg_ids, task.ports,
+                                 task.portgroups)
+    return run
+
+
+def encode_configdrive(env, ports, vifs):
+    level = CONF.sam_ironic_contrib.configdrive_compression_level
+    spool = CONF.sam_ironic_contrib.configdrive_spool_compressed
+
+    def run():
+        nova_driver._make_configdrive(None, level, spool=spool)
+    return run
+
+
+def generate_configdrive(env, ports, vifs):
+    task = fakes.make_node(ports)
+    env.ironic.add_node(task.node.uuid, task.ports)
+    driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+    driver.ironicclient = env.ironic
+    network_info = env.network_info(vifs)
+    driver._plug_vifs(task.node, None, network_info)
+    instance = collections.namedtuple('Instance', ['uuid'])(
+        task.node.instance_uuid)
+
+    def run():
+        driver._generate_configdrive(instance, task.node, network_info,
+                                     files=[])
+    return run
+
+
+def generate_configdrives(env, ports, vifs):
+    driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+    driver.ironicclient = env.ironic
+    Instance = collections.namedtuple('Instance', ['uuid'])
+    requests = []
+    for _i in range(env.batch_size):
+        task = fakes.make_node(ports)
+        env.ironic.add_node(task.node.uuid, task.ports)
+        network_info = env.network_info(vifs)
+        driver._plug_vifs(task.node, None, network_info)
+        requests.append(nova_driver.ConfigDriveRequest(
+            Instance(task.node.instance_uuid), task.node, network_info,
+            files=[]))
+
+    def run():
+        for result in driver.generate_configdrives(requests):
+            if result.error is not None:
+                raise result.error
+    return run
+
+
+def net_config_render(env, ports, vifs):
+    macs = [fakes.mac(i) for i in range(ports)]
+    links = [{'id': 'port%d' % i, 'type': 'phy',
+              'ethernet_mac_address': address}
+             for i, address in enumerate(macs)]
+    networks = []
+    for i in range(vifs):
+        links.append({'id': 'vif%d' % i, 'type': 'vlan',
+                      'vlan_link': 'port%d' % (i % ports),
+                      'vlan_id': 100 + i,
+                      'vlan_mac_address': fakes.mac(0x20000 + i)})
+        networks.append({'id': 'network%d' % i, 'link': 'vif%d' % i,
+                         'type': 'ipv4_dhcp', 'network_id': str(i)})
+    sys_interfaces = dict((address, 'eth%d' % i)
+                          for i, address in enumerate(macs))
+
+    def run():
+        data = json.loads(json.dumps({'links': links,
+                                      'networks': networks}))
+        interfaces = net_config.get_config_drive_interfaces(data)
+        net_config.write_debian_interfaces(interfaces, sys_interfaces)
+    return run
+
+
+SCENARIOS = collections.OrderedDict([
+    ('network_provider', network_provider_cycle),
+    ('dhcp_provider', dhcp_provider_cycle),
+    ('plug_vifs', plug_vifs),
+    ('network_metadata', network_metadata),
+    ('encode_configdrive', encode_configdrive),
+    ('generate_configdrive', generate_configdrive),
+    ('generate_configdrives', generate_configdrives),
+    ('net_config', net_config_render),
+])
+
+# Scenarios run for every drive size, the first only depends on it.
+DRIVE_SCENARIOS = ('encode_configdrive', 'generate_configdrive',
+                   'generate_configdrives')
+
+
+def _peak_memory_start():
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+
+def _peak_memory_stop():
+    """Peak memory in KiB since _peak_memory_start.
+
+    Without tracemalloc only the peak RSS of the whole process is known.
+    """
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak // 1024
+    return _max_rss()
+
+
+def _max_rss():
+    """Peak RSS of the whole process so far, in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_scenario(env, name, ports, vifs, concurrency):
+    runs = [SCENARIOS[name](env, ports, vifs) for _i in range(concurrency)]
+    env.reset()
+    executor = utils.GreenExecutor(concurrency)
+
+    _peak_memory_start()
+    start = time.time()
+    results = executor.map(lambda run: run(), runs)
+    wall_time = time.time() - start
+    peak_memory = _peak_memory_stop()
+
+    return {'scenario': name,
+            'ports': ports,
+            'vifs': vifs,
+            'drive_size': env.drive_size,
+            'concurrency': concurrency,
+            'wall_time': wall_time,
+            'peak_memory_kb': peak_memory,
+            'max_rss_kb': _max_rss(),
+            'errors': len([r for r in results if r.error is not None]),
+            'calls': env.calls()}
+
+
+def _ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated scenarios to run.')
+    parser.add_argument('--ports', type=_ints, default=[1, 8, 64],
+                        help='Comma separated numbers of ports per node.')
+    parser.add_argument('--vifs', type=_ints, default=[1, 16, 256],
+                        help='Comma separated numbers of VIFs per node.')
+    parser.add_argument('--concurrency', type=_ints, default=[1, 8],
+                        help='Comma separated numbers of nodes handled '
+                             'concurrently.')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Seconds every fake API call takes.')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Probability of a fake API call failing.')
+    parser.add_argument('--drive-sizes', type=_ints,
+                        default=[1024 * 1024, 64 * 1024 * 1024],
+                        help='Comma separated sizes in bytes of generated '
+                             'config drives. The peak RSS is that of the '
+                             'whole run so far, so give them in increasing '
+                             'order.')
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help='Number of nodes whose config drives are '
+                             'generated in a single batch.')
+    parser.add_argument('--max-batch-drive-size', type=int,
+                        default=1024 * 1024,
+                        help='Largest drive size generate_configdrives is '
+                             'run with, as every concurrent run holds '
+                             'batch size drives at once.')
+    parser.add_argument('--output', help='File the JSON report is written '
+                                         'to, stdout by default.')
+    args = parser.parse_args(argv)
+
+    eventlet.monkey_patch()
+    _override('provisioning_network_uuid', PROVISIONING_NETWORK)
+    _override('cleaning_network_uuid', CLEANING_NETWORK, group='neutron')
+
+    report = []
+    with Environment(args.latency, args.failure_rate, args.drive_sizes[0],
+                     args.batch_size) as env:
+        for name in args.scenarios.split(','):
+            sizes = args.drive_sizes[:1]
+            nodes = itertools.product(args.ports, args.vifs)
+            if name in DRIVE_SCENARIOS:
+                sizes = args.drive_sizes
+            if name == 'generate_configdrives':
+                sizes = [size for size in sizes
+                         if size <= args.max_batch_drive_size]
+            if name == 'encode_configdrive':
+                nodes = [(None, None)]
+            for drive_size, (ports, vifs) in itertools.product(
+                    sizes, list(nodes)):
+                env.drive_size = drive_size
+                for concurrency in args.concurrency:
+                    report.append(run_scenario(env, name, ports, vifs,
+                                               concurrency))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process fake neutron and ironic backends.
+
+The fakes keep their state in memory, count every call made to them and
+can be given a per-call latency and a random failure rate.
+"""
+
+import collections
+import copy
+import os
+import random
+import threading
+import time
+import uuid
+
+from neutronclient.common import exceptions as neutron_exceptions
+
+
+class InjectedFailure(Exception):
+    """Failure raised on purpose by a fake backend."""
+
+
+class NotFound(Exception):
+    pass
+
+
+class _Backend(object):
+
+    def __init__(self, latency=0, failure_rate=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            fail = self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise InjectedFailure(method)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+
+class FakeNeutronClient(_Backend):
+    """Just enough of python-neutronclient for the providers."""
+
+    def __init__(self, networks=None, **kwargs):
+        super(FakeNeutronClient, self).__init__(**kwargs)
+        self.ports = {}
+        self.networks = dict((net['id'], net) for net in networks or [])
+
+    def add_network(self, segmentation_id, network_id=None):
+        network_id = network_id or str(uuid.uuid4())
+        self.networks[network_id] = {
+            'id': network_id,
+            'provider:segmentation_id': segmentation_id}
+        return network_id
+
+    def add_port(self, port_id=None, **attributes):
+        """Create a port without counting it as a call."""
+        attributes['id'] = port_id or str(uuid.uuid4())
+        return self._new_port(attributes)
+
+    def _new_port(self, attributes):
+        port = {'id': str(uuid.uuid4()),
+                'mac_address': None,
+                'fixed_ips': [{'ip_address': '10.%d.%d.%d' % (
+                    self._random.randint(0, 255),
+                    self._random.randint(0, 255),
+                    self._random.randint(1, 254))}]}
+        port.update(copy.deepcopy(attributes))
+        with self._lock:
+            self.ports[port['id']] = port
+        return copy.deepcopy(port)
+
+    def create_port(self, body):
+        self._call('create_port')
+        if 'ports' in body:
+            return {'ports': [self._new_port(attributes)
+                              for attributes in body['ports']]}
+        return {'port': self._new_port(body['port'])}
+
+    def update_port(self, port_id, body):
+        self._call('update_port')
+        with self._lock:
+            if port_id not in self.ports:
+                raise neutron_exceptions.PortNotFoundClient()
+            self.ports[port_id].update(copy.deepcopy(body['port']))
+            return {'port': copy.deepcopy(self.ports[port_id])}
+
+    def delete_port(self, port_id):
+        self._call('delete_port')
+        with self._lock:
+            if self.ports.pop(port_id, None) is None:
+                raise neutron_exceptions.PortNotFoundClient()
+
+    def show_port(self, port_id):
+        self._call('show_port')
+        with self._lock:
+            if port_id not in self.ports:
+                raise neutron_exceptions.PortNotFoundClient()
+            return {'port': copy.deepcopy(self.ports[port_id])}
+
+    def list_ports(self, **filters):
+        self._call('list_ports')
+        return {'ports': self._filter(self.ports, filters)}
+
+    def show_network(self, network_id):
+        self._call('show_network')
+        return {'network': copy.deepcopy(self.networks[network_id])}
+
+    def list_networks(self, **filters):
+        self._call('list_networks')
+        return {'networks': self._filter(self.networks, filters)}
+
+    def _filter(self, objs, filters):
+        with self._lock:
+            found = []
+            for obj in objs.values():
+                for key, value in filters.items():
+                    values = value if isinstance(value, list) else [value]
+                    if obj.get(key) not in values:
+                        break
+                else:
+                    found.append(copy.deepcopy(obj))
+            return found
+
+
+class FakeIronicObject(object):
+    """Port or portgroup as returned by python-ironicclient."""
+
+    def __init__(self, address, id=None, portgroup_id=None, extra=None,
+                 local_link_connection=None):
+        self.id = id
+        self.uuid = str(uuid.uuid4())
+        self.address = address
+        self.portgroup_id = portgroup_id
+        self.extra = extra or {}
+        self.local_link_connection = local_link_connection or {}
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class FakeIronicClient(_Backend):
+    """Stands in for the ironicclient wrapper of the nova driver."""
+
+    def __init__(self, **kwargs):
+        super(FakeIronicClient, self).__init__(**kwargs)
+        self.ports = collections.defaultdict(list)
+        self.portgroups = collections.defaultdict(list)
+        self._objects = {}
+
+    def add_node(self, node_uuid, ports, portgroups=()):
+        self.ports[node_uuid] = list(ports)
+        self.portgroups[node_uuid] = list(portgroups)
+        for obj in list(ports) + list(portgroups):
+            self._objects[obj.uuid] = obj
+
+    def _find(self, obj_uuid):
+        try:
+            return self._objects[obj_uuid]
+        except KeyError:
+            raise NotFound(obj_uuid)
+
+    def call(self, method, *args, **kwargs):
+        self._call(method)
+        if method == 'node.list_ports':
+            return [copy.deepcopy(port) for port in self.ports[args[0]]]
+        if method == 'node.list_portgroups':
+            return [copy.deepcopy(pg) for pg in self.portgroups[args[0]]]
+        if method in ('port.get', 'portgroup.get'):
+            return copy.deepcopy(self._find(args[0]))
+        if method in ('port.update', 'portgroup.update'):
+            obj = self._find(args[0])
+            with self._lock:
+                for op in args[1]:
+                    key = op['path'].split('/')[-1]
+                    if op['op'] == 'remove':
+                        obj.extra.pop(key, None)
+                    else:
+                        obj.extra[key] = copy.deepcopy(op['value'])
+            return copy.deepcopy(obj)
+        raise NotImplementedError(method)
+
+
+class FakeDbPort(FakeIronicObject):
+    """Ironic Port object whose saves are counted."""
+
+    saves = 0
+    _saves_lock = threading.Lock()
+
+    def __init__(self, address, id=None, portgroup_id=None,
+                 local_link_connection=None):
+        super(FakeDbPort, self).__init__(
+            address, id=id, portgroup_id=portgroup_id,
+            local_link_connection=local_link_connection or {
+                'switch_id': '00:00:00:00:00:01', 'port_id': 'Eth1/%s' % id})
+
+    def save(self):
+        with FakeDbPort._saves_lock:
+            FakeDbPort.saves += 1
+
+
+class FakeTask(object):
+
+    def __init__(self, node, ports, portgroups=()):
+        self.node = node
+        self.ports = list(ports)
+        self.portgroups = list(portgroups)
+        self.context = collections.namedtuple(
+            'Context', ['auth_token'])('token')
+
+
+def mac(n):
+    return '52:54:00:%02x:%02x:%02x' % ((n >> 16) & 0xff, (n >> 8) & 0xff,
+                                        n & 0xff)
+
+
+def make_node(ports, portgroups=0, vifs=0):
+    """Build a node task with ports, portgroups and tenant VIFs.
+
+    Ports are spread evenly over the portgroups, VIFs over the
+    portgroups or, if there are none, over the ports.
+    """
+    Node = collections.namedtuple('Node', ['id', 'uuid', 'instance_uuid'])
+    node = Node(1, str(uuid.uuid4()), str(uuid.uuid4()))
+    groups = [FakeIronicObject(mac(0x10000 + i), id=i + 1)
+              for i in range(portgroups)]
+    members = [FakeDbPort(mac(i), id=i + 1,
+                          portgroup_id=(groups[i % portgroups].id
+                                        if groups else None))
+               for i in range(ports)]
+    targets = groups or members
+    for i in range(vifs):
+        extra = targets[i % len(targets)].extra
+        extra.setdefault('vif_port_ids', []).append(str(uuid.uuid4()))
+    return FakeTask(node, members, groups)
+
+
+class FakeInstanceMetadata(object):
+    """Stands in for nova's InstanceMetadata."""
+
+    def __init__(self, instance, content=None, extra_md=None,
+                 network_metadata=None):
+        self.instance = instance
+        self.content = content or []
+        self.extra_md = extra_md or {}
+        self.network_metadata = network_metadata
+
+    def metadata_for_config_drive(self):
+        yield ('openstack/latest/meta_data.json',
+               '{"uuid": "%s"}' % self.instance.uuid)
+        yield ('openstack/latest/network_data.json',
+               repr(self.network_metadata))
+        for path, data in self.content:
+            yield ('openstack/content/%s' % path, data)
+
+
+def config_drive_builder(size):
+    """Return a ConfigDriveBuilder stand-in writing size byte drives.
+
+    size may also be a callable returning the size of the next drive.
+    Half of every drive is random so it compresses like a real one.
+    """
+    class FakeConfigDriveBuilder(object):
+
+        def __init__(self, instance_md=None):
+            self.instance_md = instance_md
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def make_drive(self, path):
+            drive_size = size() if callable(size) else size
+            chunk = 1024 * 1024
+            with open(path, 'wb') as f:
+                written = 0
+                while written < drive_size:
+                    n = min(chunk, drive_size - written)
+                    f.write(os.urandom(n // 2))
+                    f.write(b'\0' * (n - n // 2))
+                    written += n
+
+    return FakeConfigDriveBuilder
+
+
+def network_metadata(network_info):
+    """Stands in for nova's netutils.get_network_metadata."""
+    links = []
+    networks = []
+    for i, vif in enumerate(network_info):
+        links.append({'id': 'tap%s' % vif['id'][:11], 'type': 'phy',
+                      'vif_id': vif['id'],
+                      'ethernet_mac_address': mac(0x20000 + i)})
+        networks.append({'id': 'network%d' % i, 'type': 'ipv4_dhcp',
+                         'link': 'tap%s' % vif['id'][:11],
+                         'network_id': vif['network']['id']})
+    return {'links': links, 'networks': networks, 'services': []}
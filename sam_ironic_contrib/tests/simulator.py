@@ -0,0 +1,310 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test of the providers and the nova driver against a simulated cloud.
+
+Every simulated node goes through deploy, tear down and cleaning cycles,
+all nodes at the same time, against in-memory neutron and ironic
+backends with a per-call latency and error rate. The report gives the
+throughput, the latency percentiles of every phase and the neutron ports
+and VIFs left behind. Thresholds turn it into a regression gate::
+
+    python -m sam_ironic_contrib.tests.simulator --nodes 50 --cycles 4 \\
+        --max-p99 2.5 --max-leaked-ports 0
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import math
+import sys
+import time
+
+import eventlet
+import mock
+
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import dhcp_provider
+from sam_ironic_contrib import network_provider
+from sam_ironic_contrib import nova_driver
+from sam_ironic_contrib import port_pool
+from sam_ironic_contrib.tests import benchmark
+from sam_ironic_contrib.tests import fakes
+from sam_ironic_contrib import utils
+
+PHASES = ('deploy', 'tear_down', 'clean')
+DHCP_OPTIONS = [{'opt_name': 'bootfile-name', 'opt_value': 'pxelinux.0'}]
+
+
+class Simulator(object):
+    """Simulated neutron and ironic the providers and the driver run on.
+
+    Neutron is reached through common_net.get_neutron_client, so the
+    conductor's client pool is part of the simulation, ironic ports are
+    fake objects.Port and the driver talks to a fake ironicclient.
+    """
+
+    def __init__(self, latency=0, failure_rate=0, seed=None):
+        self.neutron = fakes.FakeNeutronClient(
+            latency=latency, failure_rate=failure_rate, seed=seed)
+        self.ironic = fakes.FakeIronicClient(
+            latency=latency, failure_rate=failure_rate, seed=seed)
+        self.networks = [self.neutron.add_network(100 + i)
+                         for i in range(8)]
+        self.nodes = []
+        self.patches = [
+            mock.patch.object(clients.common_net, 'get_neutron_client',
+                              return_value=self.neutron),
+            mock.patch.object(clients, '_POOL', None),
+            mock.patch.object(port_pool, '_POOLS', {}),
+            mock.patch.object(nova_driver.neutron, 'get_client',
+                              return_value=self.neutron),
+        ]
+
+    def __enter__(self):
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *args):
+        for patch in self.patches:
+            patch.stop()
+        return False
+
+    def add_node(self, ports, portgroups, vifs):
+        node = SimulatedNode(self, ports, portgroups, vifs)
+        self.nodes.append(node)
+        return node
+
+    def leaked_ports(self):
+        """Neutron ports left behind, leaving out the pooled ones."""
+        return [port for port in self.neutron.ports.values()
+                if port.get('device_owner') != port_pool.POOL_DEVICE_OWNER]
+
+    def leaked_vifs(self):
+        """VIFs still recorded on the ports and portgroups of the nodes."""
+        return [vif for node in self.nodes
+                for obj in node.task.ports + node.task.portgroups
+                for vif in obj.extra.get('vif_port_ids', [])]
+
+    def calls(self):
+        calls = collections.Counter()
+        for method, count in self.neutron.calls.items():
+            calls['neutron.%s' % method] += count
+        for method, count in self.ironic.calls.items():
+            calls['ironic.%s' % method] += count
+        calls['db.port_save'] = fakes.FakeDbPort.saves
+        return dict(calls)
+
+
+class SimulatedNode(object):
+    """A node going through the transitions ironic and nova drive it."""
+
+    def __init__(self, simulator, ports, portgroups, vifs):
+        self.simulator = simulator
+        self.vifs = vifs
+        self.task = fakes.make_node(ports, portgroups)
+        simulator.ironic.add_node(self.task.node.uuid, self.task.ports,
+                                  self.task.portgroups)
+        self.instance = collections.namedtuple('Instance', ['uuid'])(
+            self.task.node.instance_uuid)
+        self.network_provider = network_provider.NetworkProvider()
+        self.dhcp = dhcp_provider.NeutronDHCPApi()
+        self.driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+        self.driver.ironicclient = simulator.ironic
+        self.network_info = []
+
+    def deploy(self):
+        self.network_provider.add_provisioning_network(self.task)
+        self.dhcp.update_dhcp_opts(self.task, DHCP_OPTIONS)
+        self.dhcp.get_ip_addresses(self.task)
+        # nova creates the tenant ports before plugging them.
+        networks = self.simulator.networks
+        for i in range(self.vifs):
+            port = self.simulator.neutron.create_port({'port': {
+                'network_id': networks[i % len(networks)],
+                'device_owner': 'compute:nova',
+                'device_id': self.instance.uuid}})['port']
+            self.network_info.append(
+                {'id': port['id'],
+                 'network': {'id': port['network_id'], 'meta': {}}})
+        self.driver._plug_vifs(self.task.node, self.instance,
+                               self.network_info)
+        self.network_provider.configure_tenant_networks(self.task)
+        self.network_provider.remove_provisioning_network(self.task)
+
+    def tear_down(self):
+        self.driver._unplug_vifs(self.task.node, self.instance,
+                                 self.network_info)
+        while self.network_info:
+            self.simulator.neutron.delete_port(self.network_info[-1]['id'])
+            self.network_info.pop()
+
+    def clean(self):
+        self.network_provider.add_cleaning_network(self.task)
+        self.dhcp.update_dhcp_opts(self.task, DHCP_OPTIONS)
+        self.dhcp.get_ip_addresses(self.task)
+        self.network_provider.remove_cleaning_network(self.task)
+
+    def run(self, cycles):
+        """Run cycles deploy, tear down and clean cycles.
+
+        A failed phase does not stop the cycle, like nova tearing down a
+        failed deploy. Returns the (phase, duration, error) of every
+        phase and cycle run.
+        """
+        timings = []
+        for _i in range(cycles):
+            cycle_start = time.time()
+            cycle_error = None
+            for phase in PHASES:
+                start = time.time()
+                try:
+                    getattr(self, phase)()
+                    error = None
+                except Exception as e:
+                    error = cycle_error = e
+                timings.append((phase, time.time() - start, error))
+            timings.append(('cycle', time.time() - cycle_start, cycle_error))
+        return timings
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of values, None when there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def simulate(simulator, nodes, cycles, ports, portgroups, vifs):
+    """Run cycles cycles on nodes concurrent nodes, returning the report."""
+    runs = [simulator.add_node(ports, portgroups, vifs)
+            for _i in range(nodes)]
+    simulator.neutron.reset_calls()
+    simulator.ironic.reset_calls()
+    fakes.FakeDbPort.saves = 0
+
+    start = time.time()
+    results = utils.GreenExecutor(nodes).map(
+        lambda node: node.run(cycles), runs)
+    wall_time = time.time() - start
+
+    durations = collections.defaultdict(list)
+    errors = collections.Counter()
+    for result in results:
+        for phase, duration, error in result.value or []:
+            durations[phase].append(duration)
+            if error is not None:
+                errors[phase] += 1
+        if result.error is not None:
+            errors['cycle'] += 1
+
+    latency = {}
+    for phase in PHASES + ('cycle',):
+        latency[phase] = {'p50': _percentile(durations[phase], 50),
+                          'p99': _percentile(durations[phase], 99),
+                          'max': max(durations[phase] or [None])}
+    completed = len(durations['cycle'])
+    return {'nodes': nodes,
+            'cycles': completed,
+            'wall_time': wall_time,
+            'throughput': completed / wall_time if wall_time else None,
+            'latency': latency,
+            'errors': dict(errors),
+            'leaked_ports': len(simulator.leaked_ports()),
+            'leaked_vifs': len(simulator.leaked_vifs()),
+            'calls': simulator.calls()}
+
+
+def _violations(report, args):
+    violations = []
+    p99 = report['latency']['cycle']['p99']
+    if args.max_p99 is not None and p99 is not None and p99 > args.max_p99:
+        violations.append('cycle p99 %.3fs is over %.3fs' %
+                          (p99, args.max_p99))
+    if (args.max_leaked_ports is not None and
+            report['leaked_ports'] > args.max_leaked_ports):
+        violations.append('%d ports leaked, at most %d allowed' %
+                          (report['leaked_ports'], args.max_leaked_ports))
+    failed = report['errors'].get('cycle', 0)
+    if args.max_errors is not None and failed > args.max_errors:
+        violations.append('%d cycles failed, at most %d allowed' %
+                          (failed, args.max_errors))
+    return violations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=10,
+                        help='Number of nodes cycling concurrently.')
+    parser.add_argument('--cycles', type=int, default=3,
+                        help='Number of deploy, tear down and clean cycles '
+                             'every node goes through.')
+    parser.add_argument('--ports', type=int, default=2,
+                        help='Number of ports per node.')
+    parser.add_argument('--portgroups', type=int, default=0,
+                        help='Number of portgroups per node.')
+    parser.add_argument('--vifs', type=int, default=2,
+                        help='Number of tenant VIFs per deploy.')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds every simulated API call takes.')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Probability of a simulated API call failing.')
+    parser.add_argument('--seed', type=int,
+                        help='Seed of the simulated failures.')
+    parser.add_argument('--port-pool-size', type=int, default=0,
+                        help='Size of the pools of ready neutron ports.')
+    parser.add_argument('--max-p99', type=float,
+                        help='Fail when the p99 of a cycle is over this '
+                             'many seconds.')
+    parser.add_argument('--max-leaked-ports', type=int,
+                        help='Fail when more ports than this are leaked.')
+    parser.add_argument('--max-errors', type=int,
+                        help='Fail when more cycles than this fail.')
+    parser.add_argument('--output', help='File the JSON report is written '
+                                         'to, stdout by default.')
+    args = parser.parse_args(argv)
+
+    eventlet.monkey_patch()
+    benchmark._override('provisioning_network_uuid',
+                        benchmark.PROVISIONING_NETWORK)
+    benchmark._override('cleaning_network_uuid', benchmark.CLEANING_NETWORK,
+                        group='neutron')
+    benchmark._override('host', 'simulator')
+    benchmark._override('port_pool_size', args.port_pool_size,
+                        group='sam_ironic_contrib')
+
+    with Simulator(args.latency, args.failure_rate, args.seed) as simulator:
+        report = simulate(simulator, args.nodes, args.cycles, args.ports,
+                          args.portgroups, args.vifs)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    violations = _violations(report, args)
+    for violation in violations:
+        print(violation, file=sys.stderr)
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+
+from ironic.common import exception
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import dhcp_provider
+from sam_ironic_contrib.tests import base
+from sam_ironic_contrib.tests import fakes
+
+OPTIONS = [{'opt_name': 'bootfile-name', 'opt_value': 'pxelinux.0'}]
+
+
+class FailingNeutronClient(fakes.FakeNeutronClient):
+    """Neutron failing, or hanging, on the updates of some ports."""
+
+    def __init__(self, failing=(), hanging=()):
+        super(FailingNeutronClient, self).__init__()
+        self.failing = set(failing)
+        self.hanging = set(hanging)
+
+    def update_port(self, port_id, body):
+        if port_id in self.failing:
+            self._call('update_port')
+            raise fakes.InjectedFailure('update_port')
+        if port_id in self.hanging:
+            eventlet.sleep(10)
+        return super(FailingNeutronClient, self).update_port(port_id, body)
+
+
+class UpdateDHCPOptsTestCase(base.TestCase):
+
+    def setUp(self):
+        super(UpdateDHCPOptsTestCase, self).setUp()
+        self.api = dhcp_provider.NeutronDHCPApi()
+        self.log = self.patch(dhcp_provider, 'LOG')
+        self.use_client(fakes.FakeNeutronClient())
+
+    def use_client(self, client):
+        self.client = client
+        self.patch(clients, 'get_neutron_client', return_value=client)
+
+    def _node(self, ports=2, vifs=4, provisioning=False):
+        task = fakes.make_node(ports, vifs=vifs)
+        for port in task.ports:
+            for vif in port.extra.get('vif_port_ids', []):
+                self.client.add_port(vif, mac_address=port.address)
+            if provisioning:
+                port.extra['vif_port_id'] = self.client.add_port(
+                    mac_address=port.address)['id']
+        return task
+
+    def _updated(self):
+        return sorted(port_id for port_id, n_port in self.client.ports.items()
+                      if n_port.get('extra_dhcp_opts') == OPTIONS)
+
+    def test_updates_extra_dhcp_opts(self):
+        task = fakes.make_node(4, vifs=8)
+        for port in task.ports:
+            for vif in port.extra['vif_port_ids']:
+                self.client.add_port(vif, mac_address=port.address)
+
+        self.api.update_dhcp_opts(task, OPTIONS)
+
+        self.assertEqual(8, self.client.calls['update_port'])
+        for n_port in self.client.ports.values():
+            self.assertEqual(OPTIONS, n_port['extra_dhcp_opts'])
+
+    def test_given_vifs(self):
+        task = self._node()
+        vif = task.ports[0].extra['vif_port_ids'][0]
+        self.api.update_dhcp_opts(task, OPTIONS, vifs=[vif])
+        self.assertEqual([vif], self._updated())
+
+    def test_given_no_vifs(self):
+        task = self._node()
+        self.assertRaises(exception.FailedToUpdateDHCPOptOnPort,
+                          self.api.update_dhcp_opts, task, OPTIONS, vifs=[])
+        self.assertEqual(0, self.client.calls['update_port'])
+
+    def test_node_without_vifs(self):
+        task = self._node(vifs=0)
+        self.assertRaises(exception.FailedToUpdateDHCPOptOnPort,
+                          self.api.update_dhcp_opts, task, OPTIONS)
+
+    def test_provisioning_only(self):
+        self.config(dhcp_update_provisioning_only=True)
+        task = self._node(provisioning=True)
+        self.api.update_dhcp_opts(task, OPTIONS)
+        self.assertEqual(sorted(port.extra['vif_port_id']
+                                for port in task.ports), self._updated())
+
+    def test_provisioning_only_without_provisioning_vifs(self):
+        self.config(dhcp_update_provisioning_only=True)
+        task = self._node()
+        self.api.update_dhcp_opts(task, OPTIONS)
+        self.assertEqual(4, len(self._updated()))
+
+    def _failing_node(self):
+        task = self._node()
+        failed = task.ports[0].extra['vif_port_ids'][0]
+        self.client.failing.add(failed)
+        return task, failed
+
+    def test_failure_ignored(self):
+        self.use_client(FailingNeutronClient())
+        self.config(dhcp_update_failure_policy='ignore')
+        task, failed = self._failing_node()
+
+        self.api.update_dhcp_opts(task, OPTIONS)
+        self.assertEqual(3, len(self._updated()))
+        self.assertFalse(self.log.warning.called)
+
+    def test_failure_logged(self):
+        self.use_client(FailingNeutronClient())
+        task, failed = self._failing_node()
+
+        self.api.update_dhcp_opts(task, OPTIONS)
+        self.assertEqual(3, len(self._updated()))
+        self.assertEqual(1, self.log.warning.call_count)
+        self.assertIn(failed, self.log.warning.call_args[0][1]['errors'])
+
+    def test_failure_raised(self):
+        self.use_client(FailingNeutronClient())
+        self.config(dhcp_update_failure_policy='raise')
+        task, failed = self._failing_node()
+
+        error = self.assertRaises(exception.FailedToUpdateDHCPOptOnPort,
+                                  self.api.update_dhcp_opts, task, OPTIONS)
+        self.assertIn(failed, str(error))
+        # The other ports are still updated.
+        self.assertEqual(3, len(self._updated()))
+
+    def test_timeout(self):
+        self.use_client(FailingNeutronClient())
+        self.config(dhcp_update_timeout=0.05,
+                    dhcp_update_failure_policy='raise')
+        task = self._node()
+        hung = task.ports[1].extra['vif_port_ids'][0]
+        self.client.hanging.add(hung)
+
+        error = self.assertRaises(exception.FailedToUpdateDHCPOptOnPort,
+                                  self.api.update_dhcp_opts, task, OPTIONS)
+        self.assertIn(hung, str(error))
+        self.assertIn('0.05 seconds', str(error))
+        self.assertEqual(3, len(self._updated()))
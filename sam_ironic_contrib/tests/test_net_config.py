@@ -0,0 +1,297 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import fixtures
+
+import net_config
+from sam_ironic_contrib.tests import base
+
+GOLDEN = os.path.join(os.path.dirname(__file__), 'golden')
+SYS_INTERFACES = {'52:54:00:00:00:01': 'eth0',
+                  '52:54:00:00:00:02': 'eth1',
+                  '52:54:00:00:00:03': 'eth2'}
+
+ETH0 = "auto eth0\niface eth0 inet manual\n    mtu %d\n"
+ETH1 = "auto eth1\niface eth1 inet dhcp\n"
+BOND0 = ("auto bond0\niface bond0 inet manual\n"
+         "    bond-slaves eth2 eth3\n")
+VLAN = ("auto {name}\niface {name} inet dhcp\n"
+        "    vlan-raw-device {link}\n")
+
+
+class Runner(object):
+    """Records the commands it is given and their timeouts.
+
+    Commands on the interfaces of codes return the code given for them,
+    None standing for a timeout, the others succeed.
+    """
+
+    def __init__(self, codes=None):
+        self.codes = codes or {}
+        self.commands = []
+        self.timeouts = []
+
+    def __call__(self, cmd, timeout=None):
+        self.commands.append(cmd)
+        self.timeouts.append(timeout)
+        return self.codes.get(cmd[-1], 0)
+
+    def actions(self):
+        return [tuple(cmd[1:]) for cmd in self.commands]
+
+
+class DiscoverInterfacesTestCase(base.TestCase):
+
+    def setUp(self):
+        super(DiscoverInterfacesTestCase, self).setUp()
+        self.root = self.useFixture(fixtures.TempDir()).path
+
+    def _interface(self, name, address, uevent='', master=None,
+                   perm_hwaddr=None, device=True, **files):
+        path = os.path.join(self.root, name)
+        os.mkdir(path)
+        files.update(address=address, uevent=uevent)
+        if device:
+            os.mkdir(os.path.join(path, 'device'))
+        if master:
+            os.symlink(os.path.join(self.root, master),
+                       os.path.join(path, 'master'))
+        if perm_hwaddr:
+            os.mkdir(os.path.join(path, 'bonding_slave'))
+            files['bonding_slave/perm_hwaddr'] = perm_hwaddr
+        for filename, content in files.items():
+            with open(os.path.join(path, filename), 'w') as f:
+                f.write(content + '\n')
+
+    def test_discover(self):
+        self._interface('eth0', '52:54:00:00:00:01', carrier='1',
+                        mtu='9000')
+        self._interface('eth0.100', '52:54:00:00:00:01', device=False,
+                        uevent='DEVTYPE=vlan\nINTERFACE=eth0.100')
+        os.symlink(os.path.join(self.root, 'eth0'),
+                   os.path.join(self.root, 'eth0.100', 'lower_eth0'))
+        self._interface('bond0', '52:54:00:00:00:02', device=False,
+                        uevent='DEVTYPE=bond')
+        for i, name in enumerate(('eth1', 'eth2')):
+            self._interface(name, '52:54:00:00:00:02', master='bond0',
+                            perm_hwaddr='52:54:00:00:00:1%d' % i)
+        self._interface('lo', '00:00:00:00:00:00', device=False)
+        self._interface('sit0', '00:00:00:00', device=False)
+
+        by_name, by_mac = net_config.discover_interfaces(self.root)
+
+        self.assertEqual(['eth0', 'eth0.100', 'eth1', 'eth2'],
+                         sorted(by_name))
+        vlan = by_name['eth0.100']
+        self.assertEqual(('vlan', 'eth0'), (vlan.kind, vlan.parent))
+        # The VLAN has the address of its parent, which keeps it.
+        self.assertEqual('eth0', by_mac['52:54:00:00:00:01'].name)
+        self.assertEqual((True, 9000), (by_name['eth0'].carrier,
+                                        by_name['eth0'].mtu))
+        # Bond slaves are found by their own address, not the bond's.
+        self.assertEqual({'52:54:00:00:00:01': 'eth0',
+                          '52:54:00:00:00:10': 'eth1',
+                          '52:54:00:00:00:11': 'eth2'},
+                         net_config.get_sys_interfaces(self.root))
+        self.assertEqual(('phy', 'bond0'), (by_name['eth1'].kind,
+                                            by_name['eth1'].parent))
+
+
+class RestartNetworkingTestCase(base.TestCase):
+
+    def test_all_interfaces(self):
+        runner = Runner()
+        self.assertIsNone(net_config.restart_networking(runner=runner))
+        self.assertEqual([['sudo', 'ifdown', '--exclude=lo', '-a'],
+                          ['sudo', 'ifup', '--exclude=lo', '-a']],
+                         runner.commands)
+
+    def test_files(self):
+        runner = Runner()
+        files = {'eth0.cfg': ETH1.replace('eth1', 'eth0'),
+                 'eth0.100.cfg': VLAN.format(name='eth0.100', link='eth0')}
+        report = net_config.restart_networking(files, runner)
+
+        self.assertEqual([('ifdown', 'eth0.100'), ('ifdown', 'eth0'),
+                          ('ifup', 'eth0'), ('ifup', 'eth0.100')],
+                         runner.actions())
+        self.assertEqual([0] * 4, [result['returncode'] for result in report])
+
+
+class BringUpTestCase(base.TestCase):
+
+    def setUp(self):
+        super(BringUpTestCase, self).setUp()
+        self.graph = net_config.interface_graph({
+            'eth0.cfg': ETH1.replace('eth1', 'eth0'),
+            'eth1.cfg': ETH1,
+            'eth0.100.cfg': VLAN.format(name='eth0.100', link='eth0'),
+            'eth1.200.cfg': VLAN.format(name='eth1.200', link='eth1')})
+
+    def _bring_up(self, code):
+        runner = Runner({'eth0': code})
+        report = net_config.bring_up(self.graph, self.graph, runner)
+        return runner, dict((result['interface'], result)
+                            for result in report)
+
+    def test_failed_raw_device_skips_vlans(self):
+        runner, report = self._bring_up(1)
+
+        self.assertNotIn(('ifup', 'eth0.100'), runner.actions())
+        self.assertIn(('ifup', 'eth1.200'), runner.actions())
+        self.assertTrue(report['eth0.100']['skipped'])
+        self.assertFalse(report['eth0']['timed_out'])
+        self.assertEqual(0, report['eth1.200']['returncode'])
+
+    def test_timed_out_raw_device_skips_vlans(self):
+        runner, report = self._bring_up(None)
+
+        self.assertNotIn(('ifup', 'eth0.100'), runner.actions())
+        self.assertTrue(report['eth0']['timed_out'])
+        self.assertTrue(report['eth0.100']['skipped'])
+        self.assertFalse(report['eth0.100']['timed_out'])
+
+
+class ApplyDebianInterfacesTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ApplyDebianInterfacesTestCase, self).setUp()
+        root = self.useFixture(fixtures.TempDir()).path
+        self.eni_path = os.path.join(root, 'interfaces')
+        self.eni_d_path = os.path.join(root, 'interfaces.d')
+        os.mkdir(self.eni_d_path)
+        self.patch(net_config, 'ENI_PATH', self.eni_path)
+        self.patch(net_config, 'ENI_D_PATH', self.eni_d_path)
+        self.runner = Runner()
+
+    def _files(self, **stanzas):
+        files = {self.eni_path: 'auto lo\niface lo inet loopback\n'}
+        for name, content in stanzas.items():
+            files[os.path.join(self.eni_d_path, name + '.cfg')] = content
+        return files
+
+    def _apply(self, files, timeout=None):
+        self.runner.commands = []
+        self.runner.timeouts = []
+        return net_config.apply_debian_interfaces(files, self.runner,
+                                                  timeout=timeout)
+
+    def _initial(self):
+        files = self._files(**{
+            'eth0': ETH0 % 1500,
+            'eth1': ETH1,
+            'bond0': BOND0,
+            'eth0.100': VLAN.format(name='eth0.100', link='eth0'),
+            'bond0.200': VLAN.format(name='bond0.200', link='bond0')})
+        for path, content in files.items():
+            net_config._write_file(path, content)
+        return files
+
+    def test_unchanged(self):
+        files = self._initial()
+        self.assertEqual([], self._apply(files))
+        self.assertEqual([], self.runner.commands)
+
+    def test_changed_raw_device_cycles_vlans(self):
+        files = self._initial()
+        files[os.path.join(self.eni_d_path, 'eth0.cfg')] = ETH0 % 9000
+        self._apply(files)
+
+        self.assertEqual([('ifdown', 'eth0.100'), ('ifdown', 'eth0'),
+                          ('ifup', 'eth0'), ('ifup', 'eth0.100')],
+                         self.runner.actions())
+
+    def test_changed_bond_cycles_vlans(self):
+        files = self._initial()
+        files[os.path.join(self.eni_d_path, 'bond0.cfg')] = (
+            BOND0 + '    mtu 9000\n')
+        self._apply(files)
+
+        self.assertEqual([('ifdown', 'bond0.200'), ('ifdown', 'bond0'),
+                          ('ifup', 'bond0'), ('ifup', 'bond0.200')],
+                         self.runner.actions())
+
+    def test_new_vlan_only_brings_it_up(self):
+        files = self._initial()
+        files.update(self._files(**{
+            'eth1.300': VLAN.format(name='eth1.300', link='eth1')}))
+        self._apply(files)
+
+        self.assertEqual([('ifup', 'eth1.300')], self.runner.actions())
+
+    def test_changed_main_file_restarts_all(self):
+        files = self._initial()
+        files[self.eni_path] += 'source /etc/network/interfaces.d/*.cfg\n'
+        self.assertIsNone(self._apply(files, timeout=30))
+
+        self.assertEqual([('ifdown', '--exclude=lo', '-a'),
+                          ('ifup', '--exclude=lo', '-a')],
+                         self.runner.actions())
+        self.assertEqual([30, 30], self.runner.timeouts)
+
+    def test_removed_interface(self):
+        files = self._initial()
+        del files[os.path.join(self.eni_d_path, 'eth0.100.cfg')]
+        self._apply(files)
+
+        self.assertEqual([('ifdown', 'eth0.100')], self.runner.actions())
+        self.assertFalse(os.path.exists(
+            os.path.join(self.eni_d_path, 'eth0.100.cfg')))
+
+
+class RenderersTestCase(base.TestCase):
+    """Compare the rendered files with those under golden/.
+
+    golden/<name>.json is a network_data.json, the files every renderer
+    should write for it are under golden/<name>/<renderer>/ at their
+    path on the instance.
+    """
+
+    def _interfaces(self, name):
+        with open(os.path.join(GOLDEN, name + '.json')) as f:
+            return net_config.get_config_drive_interfaces(json.load(f))
+
+    def _expected(self, name, renderer):
+        root = os.path.join(GOLDEN, name, renderer)
+        files = {}
+        for dirpath, _dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path) as f:
+                    files['/' + os.path.relpath(path, root)] = f.read()
+        return files
+
+    def _check(self, name, renderer, render):
+        expected = self._expected(name, renderer)
+        rendered = render(self._interfaces(name), SYS_INTERFACES)
+        self.assertEqual(sorted(expected), sorted(rendered))
+        for path in expected:
+            self.assertEqual(expected[path], rendered[path], path)
+
+    def test_eni_bond(self):
+        self._check('network_data_bond', 'eni',
+                    lambda interfaces, sys_interfaces:
+                    net_config.write_debian_interfaces(
+                        interfaces, sys_interfaces, skip_existing=False))
+
+    def test_networkd_bond(self):
+        self._check('network_data_bond', 'networkd',
+                    net_config.write_networkd_files)
+
+    def test_netplan_bond(self):
+        self._check('network_data_bond', 'netplan',
+                    net_config.write_netplan_config)
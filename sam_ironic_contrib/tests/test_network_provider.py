@@ -0,0 +1,282 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ironic import objects
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import network_provider
+from sam_ironic_contrib.tests import base
+from sam_ironic_contrib.tests import fakes
+
+NETWORK = 'a9b5a2c2-8cf6-4b3a-9a7b-0b1d4ee6a3c1'
+
+
+class ShuffledNeutronClient(fakes.FakeNeutronClient):
+    """Neutron returning bulk created ports in reverse order."""
+
+    def create_port(self, body):
+        created = super(ShuffledNeutronClient, self).create_port(body)
+        if 'ports' in created:
+            created['ports'].reverse()
+        return created
+
+
+class NoBulkNeutronClient(fakes.FakeNeutronClient):
+    """Neutron refusing bulk port creation."""
+
+    def create_port(self, body):
+        if 'ports' in body:
+            self._call('create_port')
+            raise fakes.InjectedFailure('bulk create')
+        return super(NoBulkNeutronClient, self).create_port(body)
+
+
+class NetworkProviderTestCase(base.TestCase):
+
+    def setUp(self):
+        super(NetworkProviderTestCase, self).setUp()
+        self.config(neutron_retry_interval=0)
+        self.provider = network_provider.NetworkProvider()
+        self.patch(network_provider, '_PORT_STATE_CACHE', None)
+
+    def use_client(self, client):
+        self.client = client
+        self.patch(clients, 'get_neutron_client', return_value=client)
+        return client
+
+
+class CreatePortsTestCase(NetworkProviderTestCase):
+
+    def _bodies(self, count):
+        return [{'network_id': NETWORK, 'mac_address': fakes.mac(i)}
+                for i in range(count)]
+
+    def test_one_bulk_call(self):
+        client = fakes.FakeNeutronClient()
+        created = self.provider._create_ports(client, self._bodies(8))
+        self.assertEqual(1, client.calls['create_port'])
+        self.assertEqual(sorted(fakes.mac(i) for i in range(8)),
+                         sorted(created))
+
+    def test_no_ports(self):
+        client = fakes.FakeNeutronClient()
+        self.assertEqual({}, self.provider._create_ports(client, []))
+        self.assertEqual(0, client.calls['create_port'])
+
+    def test_keyed_by_mac(self):
+        client = ShuffledNeutronClient()
+        created = self.provider._create_ports(client, self._bodies(4))
+        for mac, n_port in created.items():
+            self.assertEqual(mac, n_port['mac_address'])
+
+    def test_bulk_failure_falls_back_to_single_ports(self):
+        client = NoBulkNeutronClient()
+        created = self.provider._create_ports(client, self._bodies(3))
+        # The refused bulk call and one call per port.
+        self.assertEqual(4, client.calls['create_port'])
+        self.assertEqual(3, len(client.ports))
+        self.assertEqual(sorted(fakes.mac(i) for i in range(3)),
+                         sorted(created))
+
+
+class AddNetworkTestCase(NetworkProviderTestCase):
+
+    def test_one_bulk_call_per_node(self):
+        client = self.use_client(ShuffledNeutronClient())
+        task = fakes.make_node(8)
+        vifs = self.provider._add_network(task, NETWORK)
+
+        self.assertEqual(1, client.calls['create_port'])
+        self.assertEqual(8, len(client.ports))
+        for port in task.ports:
+            n_port = client.ports[vifs[port.uuid]]
+            self.assertEqual(port.address, n_port['mac_address'])
+            self.assertEqual(NETWORK, n_port['network_id'])
+            self.assertEqual(n_port['id'], port.extra['vif_port_id'])
+
+    def test_fallback_binds_every_port(self):
+        client = self.use_client(NoBulkNeutronClient())
+        task = fakes.make_node(3)
+        vifs = self.provider._add_network(task, NETWORK)
+
+        self.assertEqual(4, client.calls['create_port'])
+        for port in task.ports:
+            self.assertEqual(port.address,
+                             client.ports[vifs[port.uuid]]['mac_address'])
+
+
+class ReconcilePortsTestCase(NetworkProviderTestCase):
+    """Ports left on the network by an earlier attempt are reused."""
+
+    def setUp(self):
+        super(ReconcilePortsTestCase, self).setUp()
+        self.client = self.use_client(fakes.FakeNeutronClient())
+        self.task = fakes.make_node(4)
+        self.vifs = self._add()
+        self.client.reset_calls()
+
+    def _add(self):
+        return self.provider._add_network(self.task, NETWORK, reconcile=True)
+
+    def _retry(self):
+        # A failed attempt leaves the ports on neutron, not on the node.
+        for port in self.task.ports:
+            port.extra.pop('vif_port_id', None)
+        return self._add()
+
+    def test_ports_reused(self):
+        self.assertEqual(self.vifs, self._retry())
+        self.assertEqual(0, self.client.calls['create_port'])
+        self.assertEqual(0, self.client.calls['update_port'])
+        self.assertEqual(0, self.client.calls['delete_port'])
+
+    def test_missing_port_created(self):
+        lost = self.task.ports[0]
+        del self.client.ports[self.vifs[lost.uuid]]
+
+        vifs = self._retry()
+        self.assertEqual(1, self.client.calls['create_port'])
+        self.assertEqual(lost.address,
+                         self.client.ports[vifs[lost.uuid]]['mac_address'])
+        self.assertEqual(4, len(self.client.ports))
+
+    def test_differing_binding_rebound(self):
+        vif = self.vifs[self.task.ports[1].uuid]
+        self.client.ports[vif]['binding:host_id'] = 'elsewhere'
+
+        self.assertEqual(self.vifs, self._retry())
+        self.assertEqual(1, self.client.calls['update_port'])
+        self.assertEqual(self.task.node.uuid,
+                         self.client.ports[vif]['binding:host_id'])
+        self.assertEqual(0, self.client.calls['create_port'])
+
+    def test_stray_ports_deleted(self):
+        owner = {'network_id': NETWORK, 'device_id': self.task.node.uuid}
+        unknown = self.client.add_port(mac_address=fakes.mac(0x100), **owner)
+        duplicate = self.client.add_port(
+            mac_address=self.task.ports[2].address, **owner)
+
+        self.assertEqual(self.vifs, self._retry())
+        self.assertEqual(2, self.client.calls['delete_port'])
+        self.assertNotIn(unknown['id'], self.client.ports)
+        self.assertNotIn(duplicate['id'], self.client.ports)
+        self.assertEqual(4, len(self.client.ports))
+
+    def test_retries_add_no_ports(self):
+        for _i in range(3):
+            self._retry()
+        self.assertEqual(0, self.client.calls['create_port'])
+        self.assertEqual(4, len(self.client.ports))
+
+
+class SaveExtrasTestCase(NetworkProviderTestCase):
+    """Every changed port is saved once, whatever the size of the node."""
+
+    # Node sizes every test runs with.
+    SIZES = (8, 256)
+
+    def setUp(self):
+        super(SaveExtrasTestCase, self).setUp()
+        self.use_client(fakes.FakeNeutronClient())
+        self.save = self.patch(fakes.FakeDbPort, 'save', autospec=True)
+        self.reload = self.patch(objects.Port, 'list_by_node_id',
+                                 create=True)
+
+    def assertSavedOnce(self, ports):
+        saved = [call[0][0] for call in self.save.call_args_list]
+        self.assertEqual(len(ports), self.save.call_count)
+        self.assertEqual(sorted(port.uuid for port in ports),
+                         sorted(port.uuid for port in saved))
+        self.assertFalse(self.reload.called)
+
+    def test_add_network(self):
+        for size in self.SIZES:
+            self.save.reset_mock()
+            task = fakes.make_node(size)
+            self.provider._add_network(task, NETWORK)
+            self.assertSavedOnce(task.ports)
+
+    def test_remove_network(self):
+        for size in self.SIZES:
+            task = fakes.make_node(size)
+            self.provider._add_network(task, NETWORK)
+            self.save.reset_mock()
+            failed = task.ports[0].extra['vif_port_id']
+            self.patch(self.client, 'delete_port',
+                       side_effect=self._failing_delete(failed))
+
+            self.provider._remove_network(task)
+            self.assertSavedOnce(task.ports[1:])
+            self.assertEqual(failed, task.ports[0].extra['vif_port_id'])
+
+    def _failing_delete(self, failed):
+        ports = self.client.ports
+
+        def delete_port(port_id):
+            if port_id == failed:
+                raise fakes.InjectedFailure('delete')
+            ports.pop(port_id, None)
+        return delete_port
+
+    def test_only_changed_ports_saved(self):
+        for size in self.SIZES:
+            self.save.reset_mock()
+            task = fakes.make_node(size)
+            extras = dict((port.uuid, dict(port.extra))
+                          for port in task.ports)
+            changed = task.ports[::2]
+            for port in changed:
+                extras[port.uuid]['vif_port_id'] = 'vif'
+
+            self.provider._save_extras(task, extras)
+            self.assertSavedOnce(changed)
+
+
+class ConfigureTenantNetworksTestCase(NetworkProviderTestCase):
+
+    def setUp(self):
+        super(ConfigureTenantNetworksTestCase, self).setUp()
+        self.client = self.use_client(fakes.FakeNeutronClient())
+        self.task = fakes.make_node(4, vifs=8)
+        for port in self.task.ports:
+            for vif in port.extra['vif_port_ids']:
+                self.client.add_port(vif, mac_address=port.address)
+
+    def _configure(self):
+        self.client.reset_calls()
+        self.provider.configure_tenant_networks(self.task)
+        return self.client.calls
+
+    def test_unchanged_ports_skipped(self):
+        self._configure()
+        calls = self._configure()
+        self.assertEqual(1, calls['list_ports'])
+        self.assertEqual(0, calls['update_port'])
+
+    def test_changes_outside_conductor_fixed(self):
+        self._configure()
+        vif = self.task.ports[0].extra['vif_port_ids'][0]
+        self.client.ports[vif]['binding:host_id'] = 'elsewhere'
+
+        calls = self._configure()
+        self.assertEqual(1, calls['update_port'])
+        self.assertEqual(self.task.node.uuid,
+                         self.client.ports[vif]['binding:host_id'])
+
+    def test_cache_bounded(self):
+        self.config(port_state_cache_ttl=300, port_state_cache_size=4)
+        self._configure()
+        calls = self._configure()
+        self.assertEqual(4, network_provider._PORT_STATE_CACHE.stats()['size'])
+        self.assertEqual(1, calls['list_ports'])
+        self.assertEqual(0, calls['update_port'])
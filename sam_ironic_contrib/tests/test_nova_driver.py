@@ -0,0 +1,404 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import collections
+import gzip
+import io
+import uuid
+
+from sam_ironic_contrib import nova_driver
+from sam_ironic_contrib.tests import base
+from sam_ironic_contrib.tests import fakes
+
+
+class NodeNetworkIndexTestCase(base.TestCase):
+
+    def test_vifs_on_ports(self):
+        task = fakes.make_node(64, vifs=512)
+        index = nova_driver.NodeNetworkIndex(task.ports, task.portgroups)
+
+        self.assertEqual(512, len(index.by_vif))
+        self.assertEqual({}, index.members)
+        for port in task.ports:
+            for vif in port.extra['vif_port_ids']:
+                self.assertIs(port, index.by_vif[vif])
+
+    def test_vifs_on_portgroups(self):
+        task = fakes.make_node(64, portgroups=8, vifs=512)
+        index = nova_driver.NodeNetworkIndex(task.ports, task.portgroups)
+
+        self.assertEqual(512, len(index.by_vif))
+        for pg in task.portgroups:
+            for vif in pg.extra['vif_port_ids']:
+                self.assertIs(pg, index.by_vif[vif])
+            members = index.members[pg.id]
+            self.assertEqual(8, len(members))
+            self.assertTrue(all(port.portgroup_id == pg.id
+                                for port in members))
+
+
+class NetworkMetadataTestCase(base.TestCase):
+
+    def setUp(self):
+        super(NetworkMetadataTestCase, self).setUp()
+        self.driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+        self.patch(nova_driver.netutils, 'get_network_metadata',
+                   side_effect=fakes.network_metadata)
+
+    def _metadata(self, task):
+        network_info = []
+        seg_ids = {}
+        for obj in list(task.ports) + list(task.portgroups):
+            for vif in obj.extra.get('vif_port_ids', []):
+                network_id = str(uuid.uuid4())
+                seg_ids[network_id] = len(seg_ids) + 100
+                network_info.append({'id': vif,
+                                     'network': {'id': network_id}})
+        metadata = self.driver._network_metadata(
+            network_info, seg_ids, task.ports, task.portgroups)
+        return dict((link['id'], link) for link in metadata['links'])
+
+    def test_vlans_on_bonds(self):
+        task = fakes.make_node(16, portgroups=4, vifs=400)
+        links = self._metadata(task)
+
+        self.assertEqual(400 + 16 + 4, len(links))
+        for pg in task.portgroups:
+            bond = links[pg.uuid]
+            self.assertEqual('bond', bond['type'])
+            self.assertEqual(4, len(bond['bond_links']))
+            for vif in pg.extra['vif_port_ids']:
+                self.assertEqual(pg.uuid, links['tap%s' % vif[:11]]
+                                 ['vlan_link'])
+
+    def test_portgroup_without_members(self):
+        task = fakes.make_node(0, portgroups=1, vifs=3)
+        pg = task.portgroups[0]
+        links = self._metadata(task)
+
+        bond = links[pg.uuid]
+        self.assertEqual([], bond['bond_links'])
+        self.assertEqual(pg.address, bond['ethernet_mac_address'])
+
+    def test_portgroup_without_address(self):
+        task = fakes.make_node(2, portgroups=1, vifs=1)
+        pg = task.portgroups[0]
+        pg.address = None
+        links = self._metadata(task)
+
+        self.assertEqual(task.ports[0].address,
+                         links[pg.uuid]['ethernet_mac_address'])
+
+
+class SegmentationIdsTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SegmentationIdsTestCase, self).setUp()
+        self.client = fakes.FakeNeutronClient()
+        self.patch(nova_driver, '_NETWORK_CACHE', None)
+        self.patch(nova_driver.neutron, 'get_client',
+                   return_value=self.client)
+        self.driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+
+    def test_chunked(self):
+        self.config(port_list_chunk_size=2)
+        networks = [self.client.add_network(100 + i) for i in range(5)]
+
+        seg_ids = self.driver._get_segmentation_ids(networks + networks[:2])
+
+        self.assertEqual(dict((network, 100 + i)
+                              for i, network in enumerate(networks)),
+                         seg_ids)
+        self.assertEqual(3, self.client.calls['list_networks'])
+
+
+class FlakyIronicClient(fakes.FakeIronicClient):
+    """Ironic failing the next updates of some ports or portgroups.
+
+    failures maps the uuid of an object to the number of its updates
+    which fail before one succeeds.
+    """
+
+    def __init__(self):
+        super(FlakyIronicClient, self).__init__()
+        self.failures = collections.Counter()
+
+    def call(self, method, *args, **kwargs):
+        if method.endswith('.update') and self.failures[args[0]]:
+            self.failures[args[0]] -= 1
+            self._call(method)
+            raise fakes.InjectedFailure(method)
+        return super(FlakyIronicClient, self).call(method, *args, **kwargs)
+
+
+class VifsTestCase(base.TestCase):
+
+    def setUp(self):
+        super(VifsTestCase, self).setUp()
+        self.config(ironic_api_retry_interval=0)
+        self.ironic = FlakyIronicClient()
+        self.log = self.patch(nova_driver, 'LOG')
+        self.driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+        self.driver.ironicclient = self.ironic
+
+    def _node(self, ports, portgroups=0, vifs=0):
+        task = fakes.make_node(ports, portgroups=portgroups, vifs=vifs)
+        self.ironic.add_node(task.node.uuid, task.ports, task.portgroups)
+        return task
+
+
+def vifs(count, physnet=None):
+    meta = {'physical_network': physnet} if physnet else {}
+    return [{'id': str(uuid.uuid4()),
+             'network': {'id': str(uuid.uuid4()), 'meta': meta}}
+            for _i in range(count)]
+
+
+class PlugVifsTestCase(VifsTestCase):
+
+    def test_one_write_per_port(self):
+        task = self._node(2)
+        network_info = vifs(16)
+
+        self.driver._plug_vifs(task.node, None, network_info)
+
+        self.assertEqual(2, self.ironic.calls['port.update'])
+        self.assertEqual(0, self.ironic.calls['port.get'])
+        self.assertEqual(1, self.ironic.calls['node.list_ports'])
+        self.assertEqual(sorted(vif['id'] for vif in network_info),
+                         sorted(vif for port in task.ports
+                                for vif in port.extra['vif_port_ids']))
+        for port in task.ports:
+            self.assertEqual(8, len(port.extra['vif_port_ids']))
+
+    def test_one_write_per_portgroup(self):
+        task = self._node(4, portgroups=2)
+
+        self.driver._plug_vifs(task.node, None, vifs(16))
+
+        self.assertEqual(2, self.ironic.calls['portgroup.update'])
+        self.assertEqual(0, self.ironic.calls['port.update'])
+        for pg in task.portgroups:
+            self.assertEqual(8, len(pg.extra['vif_port_ids']))
+
+    def test_only_changed_ports_written(self):
+        task = self._node(4, vifs=3)
+        plugged = [{'id': vif, 'network': {'id': str(uuid.uuid4())}}
+                   for port in task.ports
+                   for vif in port.extra.get('vif_port_ids', [])]
+
+        self.driver._plug_vifs(task.node, None, plugged + vifs(1))
+
+        self.assertEqual(1, self.ironic.calls['port.update'])
+        self.assertEqual(1, len(task.ports[3].extra['vif_port_ids']))
+
+    def test_raises_after_retries(self):
+        self.config(ironic_api_retries=1)
+        task = self._node(2)
+        self.ironic.failures[task.ports[1].uuid] = 2
+
+        self.assertRaises(fakes.InjectedFailure, self.driver._plug_vifs,
+                          task.node, None, vifs(4))
+
+        self.assertEqual(3, self.ironic.calls['port.update'])
+        self.assertEqual(2, len(task.ports[0].extra['vif_port_ids']))
+        self.assertEqual(1, self.log.error.call_count)
+
+
+class VifPlacementTestCase(VifsTestCase):
+
+    def _placed(self, task):
+        return dict((vif, obj.uuid)
+                    for obj in list(task.ports) + list(task.portgroups)
+                    for vif in obj.extra.get('vif_port_ids', []))
+
+    def test_round_robin_balanced(self):
+        task = self._node(3, vifs=2)
+
+        self.driver._plug_vifs(task.node, None, vifs(7))
+
+        self.assertEqual([3, 3, 3], [len(port.extra['vif_port_ids'])
+                                     for port in task.ports])
+
+    def test_physnet(self):
+        self.config(vif_placement='physnet')
+        log = self.patch(nova_driver.vif_placement, 'LOG')
+        task = self._node(4)
+        for port in task.ports:
+            port.local_link_connection = {}
+        task.ports[0].physical_network = 'a'
+        task.ports[1].physical_network = 'b'
+        task.ports[2].local_link_connection = {'switch_id': fakes.mac(1)}
+        on_b, on_c, unknown = vifs(2, 'b'), vifs(1, 'c'), vifs(1)
+
+        self.driver._plug_vifs(task.node, None, on_b + on_c + unknown)
+
+        placed = self._placed(task)
+        for vif in on_b:
+            self.assertEqual(task.ports[1].uuid, placed[vif['id']])
+        # Without a matching port, a cabled one is used.
+        for vif in on_c + unknown:
+            self.assertEqual(task.ports[2].uuid, placed[vif['id']])
+        self.assertEqual(1, log.warning.call_count)
+
+    def test_physnet_portgroups(self):
+        self.config(vif_placement='physnet')
+        task = self._node(4, portgroups=2)
+        task.ports[1].physical_network = 'b'
+        network_info = vifs(3, 'b')
+
+        self.driver._plug_vifs(task.node, None, network_info)
+
+        group = task.portgroups[task.ports[1].portgroup_id - 1]
+        self.assertEqual(3, len(group.extra['vif_port_ids']))
+        self.assertEqual(1, self.ironic.calls['portgroup.update'])
+
+    def test_sticky_stable_across_replug(self):
+        self.config(vif_placement='sticky')
+        task = self._node(4)
+        network_info = vifs(16)
+        self.driver._plug_vifs(task.node, None, network_info)
+        placed = self._placed(task)
+
+        self.driver._unplug_vifs(task.node, None, network_info)
+        self.assertEqual({}, self._placed(task))
+        self.driver._plug_vifs(task.node, None, network_info[::-1])
+
+        self.assertEqual(placed, self._placed(task))
+
+    def test_replug_writes_nothing(self):
+        for name in sorted(nova_driver.vif_placement.PLACEMENTS):
+            self.config(vif_placement=name)
+            task = self._node(4)
+            network_info = vifs(16)
+            self.driver._plug_vifs(task.node, None, network_info)
+            placed = self._placed(task)
+            self.ironic.reset_calls()
+
+            self.driver._plug_vifs(task.node, None, network_info)
+
+            self.assertEqual(0, self.ironic.calls['port.update'], name)
+            self.assertEqual(placed, self._placed(task), name)
+
+
+class UnplugVifsTestCase(VifsTestCase):
+
+    def test_skips_objects_without_vifs(self):
+        task = self._node(4, vifs=2)
+        task.ports[2].extra['vif_port_ids'] = []
+
+        self.driver._unplug_vifs(task.node, None, [])
+
+        self.assertEqual(2, self.ironic.calls['port.update'])
+        for port in task.ports:
+            self.assertFalse(port.extra.get('vif_port_ids'))
+
+    def test_portgroups(self):
+        task = self._node(4, portgroups=2, vifs=1)
+
+        self.driver._unplug_vifs(task.node, None, [])
+
+        self.assertEqual(1, self.ironic.calls['portgroup.update'])
+        self.assertEqual(0, self.ironic.calls['port.update'])
+        self.assertNotIn('vif_port_ids', task.portgroups[0].extra)
+
+    def test_retries(self):
+        self.config(ironic_api_retries=2)
+        task = self._node(2, vifs=2)
+        self.ironic.failures[task.ports[0].uuid] = 2
+
+        self.driver._unplug_vifs(task.node, None, [])
+
+        self.assertEqual(4, self.ironic.calls['port.update'])
+        for port in task.ports:
+            self.assertNotIn('vif_port_ids', port.extra)
+        self.assertFalse(self.log.error.called)
+
+    def test_raises_after_retries(self):
+        self.config(ironic_api_retries=1)
+        task = self._node(2, vifs=2)
+        self.ironic.failures[task.ports[0].uuid] = 2
+
+        self.assertRaises(fakes.InjectedFailure, self.driver._unplug_vifs,
+                          task.node, None, [])
+
+        self.assertEqual(3, self.ironic.calls['port.update'])
+        self.assertIn('vif_port_ids', task.ports[0].extra)
+        # The other port is still unplugged.
+        self.assertNotIn('vif_port_ids', task.ports[1].extra)
+        self.assertEqual(1, self.log.error.call_count)
+
+
+class GenerateConfigDrivesTestCase(base.TestCase):
+
+    def setUp(self):
+        super(GenerateConfigDrivesTestCase, self).setUp()
+        self.config(configdrive_build_workers=2)
+        self.neutron = fakes.FakeNeutronClient()
+        self.ironic = fakes.FakeIronicClient()
+        self.patch(nova_driver.neutron, 'get_client',
+                   return_value=self.neutron)
+        self.patch(nova_driver.netutils, 'get_network_metadata',
+                   side_effect=fakes.network_metadata)
+        self.patch(nova_driver.instance_metadata, 'InstanceMetadata',
+                   fakes.FakeInstanceMetadata)
+        self.patch(nova_driver.configdrive, 'ConfigDriveBuilder',
+                   fakes.config_drive_builder(4096))
+        self.patch(nova_driver, '_NETWORK_CACHE', None)
+        self.driver = object.__new__(nova_driver.DynamicNetworkIronicDriver)
+        self.driver.ironicclient = self.ironic
+        self.network = self.neutron.add_network(100)
+
+    def _request(self, plug=True):
+        task = fakes.make_node(2)
+        self.ironic.add_node(task.node.uuid, task.ports)
+        network_info = [{'id': str(uuid.uuid4()),
+                         'network': {'id': self.network}}
+                        for _i in range(4)]
+        if plug:
+            self.driver._plug_vifs(task.node, None, network_info)
+        instance = collections.namedtuple('Instance', ['uuid'])(
+            task.node.instance_uuid)
+        return nova_driver.ConfigDriveRequest(instance, task.node,
+                                              network_info, files=[])
+
+    def test_batch(self):
+        requests = [self._request() for _i in range(4)]
+        self.neutron.reset_calls()
+
+        results = self.driver.generate_configdrives(requests)
+
+        self.assertEqual(requests, [result.item for result in results])
+        for result in results:
+            self.assertIsNone(result.error)
+            compressed = io.BytesIO(base64.b64decode(result.value))
+            with gzip.GzipFile(fileobj=compressed) as drive:
+                self.assertEqual(4096, len(drive.read()))
+        self.assertEqual(1, self.neutron.calls['list_networks'])
+
+    def test_failed_request(self):
+        log = self.patch(nova_driver, 'LOG')
+        requests = [self._request(), self._request(plug=False),
+                    self._request()]
+
+        results = self.driver.generate_configdrives(requests)
+
+        self.assertEqual(requests, [result.item for result in results])
+        self.assertIsInstance(results[1].error, KeyError)
+        self.assertIsNone(results[1].value)
+        for result in results[::2]:
+            self.assertIsNone(result.error)
+            self.assertIsNotNone(result.value)
+        self.assertEqual(1, log.error.call_count)
@@ -0,0 +1,104 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sam_ironic_contrib import clients
+from sam_ironic_contrib import metrics
+from sam_ironic_contrib import network_provider
+from sam_ironic_contrib import port_pool
+from sam_ironic_contrib.tests import base
+from sam_ironic_contrib.tests import fakes
+
+NETWORK = 'a9b5a2c2-8cf6-4b3a-9a7b-0b1d4ee6a3c1'
+OWNER = 'conductor'
+
+
+class PortPoolTestCase(base.TestCase):
+
+    def setUp(self):
+        super(PortPoolTestCase, self).setUp()
+        self.config(port_pool_size=4, neutron_retry_interval=0,
+                    neutron_retries=0)
+        self.client = fakes.FakeNeutronClient()
+        self.sink = metrics.MemorySink()
+        self.pool = port_pool.PortPool(NETWORK, 4, OWNER)
+        self.patch(clients, 'get_neutron_client', return_value=self.client)
+        self.patch(port_pool, '_POOLS', {NETWORK: self.pool})
+        self.patch(network_provider, '_PORT_STATE_CACHE', None)
+        self.patch(metrics, '_SINK', self.sink)
+        # Refill in the calling thread so tests see its result.
+        self.patch(self.pool, 'refill_async',
+                   side_effect=self.pool._refill)
+        self.provider = network_provider.NetworkProvider()
+
+    def _pooled(self):
+        return [n_port for n_port in self.client.ports.values()
+                if n_port['device_owner'] == port_pool.POOL_DEVICE_OWNER]
+
+    def _counter(self, name):
+        return self.sink.counters.get('sam_ironic_contrib.%s' % name, 0)
+
+    def test_refill(self):
+        self.pool.refill_async()
+        self.assertEqual(4, len(self._pooled()))
+        self.assertEqual(1, self.client.calls['create_port'])
+
+        self.pool.refill_async()
+        self.assertEqual(4, len(self._pooled()))
+        self.assertEqual(1, self.client.calls['create_port'])
+
+    def test_bind_from_pool(self):
+        self.pool.refill_async()
+        pooled = set(n_port['id'] for n_port in self._pooled())
+        self.client.reset_calls()
+        task = fakes.make_node(3)
+
+        vifs = self.provider._add_network(task, NETWORK)
+
+        self.assertEqual(set(), set(vifs.values()) - pooled)
+        for port in task.ports:
+            n_port = self.client.ports[vifs[port.uuid]]
+            self.assertEqual(port.address, n_port['mac_address'])
+            self.assertEqual(task.node.uuid, n_port['binding:host_id'])
+        # Only the refill of the three ports taken creates any.
+        self.assertEqual(1, self.client.calls['create_port'])
+        self.assertEqual(4, len(self._pooled()))
+
+    def test_release_on_failed_bind(self):
+        self.pool.refill_async()
+        failed = self.pool._ports[0]['id']
+        update = self.client.update_port
+
+        def update_port(port_id, body):
+            if port_id == failed:
+                raise fakes.InjectedFailure('update_port')
+            return update(port_id, body)
+        self.client.update_port = update_port
+        task = fakes.make_node(2)
+
+        vifs = self.provider._add_network(task, NETWORK)
+
+        self.assertNotIn(failed, vifs.values())
+        self.assertEqual(2, len(vifs))
+        self.assertIn(failed, [n_port['id'] for n_port in self.pool._ports])
+
+    def test_list_failure_creates_ports(self):
+        self.patch(self.client, 'list_ports',
+                   side_effect=fakes.InjectedFailure('list_ports'))
+        task = fakes.make_node(2)
+
+        vifs = self.provider._add_network(task, NETWORK)
+
+        self.assertEqual(2, len(vifs))
+        self.assertEqual(2, self._counter('port_pool.missed'))
+        self.assertEqual(0, self._counter('port_pool.acquired'))
@@ -0,0 +1,190 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import functools
+import threading
+import time
+
+import eventlet
+from eventlet import greenpool
+from oslo_config import cfg
+import six
+
+utils_opts = [
+    cfg.IntOpt('port_list_chunk_size',
+               default=50,
+               min=1,
+               help='Maximum number of port or network ids sent in a single '
+                    'neutron list request, keeps request URLs short.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(utils_opts, group='sam_ironic_contrib')
+
+Result = collections.namedtuple('Result', ['item', 'value', 'error'])
+
+
+class CallTimeout(Exception):
+    """A call made through an executor ran past its timeout."""
+
+    def __init__(self, timeout):
+        super(CallTimeout, self).__init__(
+            'Call did not complete within %s seconds' % timeout)
+
+
+def _call(func, item):
+    try:
+        return Result(item, func(item), None)
+    except Exception as e:
+        return Result(item, None, e)
+
+
+class GreenExecutor(object):
+    """Runs calls concurrently on a bounded pool of green threads."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+
+    def map(self, func, items, timeout=None):
+        def call(item):
+            with eventlet.Timeout(timeout, CallTimeout(timeout)):
+                return func(item)
+
+        pool = greenpool.GreenPool(self.max_workers)
+        return list(pool.imap(functools.partial(_call, call), items))
+
+
+class ThreadExecutor(object):
+    """Runs calls concurrently on a bounded pool of native threads."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+
+    def map(self, func, items, timeout=None):
+        def call(item):
+            if timeout is None:
+                return func(item)
+            # A native thread can not be interrupted, so the call is left
+            # running in the background once it has timed out.
+            box = []
+            thread = threading.Thread(
+                target=lambda: box.append(_call(func, item)))
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+            if not box:
+                raise CallTimeout(timeout)
+            if box[0].error is not None:
+                raise box[0].error
+            return box[0].value
+
+        items = list(items)
+        results = [None] * len(items)
+        work = six.moves.queue.Queue()
+        for i, item in enumerate(items):
+            work.put((i, item))
+
+        def worker():
+            while True:
+                try:
+                    i, item = work.get_nowait()
+                except six.moves.queue.Empty:
+                    return
+                results[i] = _call(call, item)
+
+        threads = [threading.Thread(target=worker)
+                   for _i in range(min(self.max_workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+EXECUTORS = {
+    'green': GreenExecutor,
+    'thread': ThreadExecutor,
+}
+
+
+def get_executor(kind, max_workers):
+    return EXECUTORS[kind](max_workers)
+
+
+def map_with_retries(executor, func, items, retries=0, interval=0,
+                     timeout=None):
+    """Map func over items with executor, retrying the failed items.
+
+    Every retry waits twice as long as the one before it. Returns one
+    Result per item, in the order the items were given.
+    """
+    items = list(items)
+    results = executor.map(func, items, timeout=timeout)
+    for attempt in range(retries):
+        failed = [i for i, result in enumerate(results)
+                  if result.error is not None]
+        if not failed:
+            break
+        time.sleep(interval * (2 ** attempt))
+        retried = executor.map(func, [items[i] for i in failed],
+                               timeout=timeout)
+        for i, result in zip(failed, retried):
+            results[i] = result
+    return results
+
+
+class TTLCache(object):
+    """Thread-safe mapping whose entries expire after a per-entry TTL.
+
+    When max_size is set the least recently used entries are evicted to
+    make room for new ones. Lookups are counted in hits and misses.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Drop key from the cache, or every entry if key is None."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data)}
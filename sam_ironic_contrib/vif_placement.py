@@ -0,0 +1,99 @@
+# Copyright 2016, Cisco Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Strategies choosing the port or portgroup a new VIF is plugged into.
+
+A strategy only looks at the ports and portgroups of the node as already
+listed by the driver. VIFs which are plugged already are never moved, so
+replugging the same VIFs changes nothing.
+"""
+
+import hashlib
+
+from oslo_log import log as logging
+
+from nova.i18n import _LW
+
+LOG = logging.getLogger(__name__)
+
+
+class RoundRobinPlacement(object):
+    """Spreads VIFs evenly, on the target with the fewest VIFs first."""
+
+    def candidates(self, vif, targets, index):
+        return targets
+
+    def place(self, vif, targets, assigned, index):
+        """Return the target of targets vif should be plugged into.
+
+        assigned maps the uuid of every target to the VIF ids plugged
+        into it and index is the NodeNetworkIndex of the node.
+        """
+        candidates = self.candidates(vif, targets, index) or targets
+        return min(candidates, key=lambda target: len(assigned[target.uuid]))
+
+
+class PhysnetPlacement(RoundRobinPlacement):
+    """Plugs VIFs into targets cabled to the physical network of the VIF.
+
+    Targets are matched on the physical_network of their ports. VIFs
+    without a physical network, or whose network no target is on, go to
+    targets with a local_link_connection.
+    """
+
+    def _ports(self, target, index):
+        return index.members.get(target.id) or [target]
+
+    def candidates(self, vif, targets, index):
+        physnet = (vif['network'].get('meta') or {}).get('physical_network')
+        if physnet:
+            matching = [target for target in targets
+                        if any(getattr(port, 'physical_network', None) ==
+                               physnet
+                               for port in self._ports(target, index))]
+            if matching:
+                return matching
+            LOG.warning(_LW("No port of the node is on physical network "
+                            "%(physnet)s of VIF %(vif)s"),
+                        {'physnet': physnet, 'vif': vif['id']})
+        return [target for target in targets
+                if any(port.local_link_connection
+                       for port in self._ports(target, index))]
+
+
+class StickyPlacement(object):
+    """Always plugs a VIF into the same target, whatever the other VIFs.
+
+    Targets are ranked by a hash of the VIF and target ids, so a VIF
+    plugged again after being unplugged lands on the target it was on
+    and keeps its neutron binding. Adding or removing a target only moves
+    the VIFs of that target.
+    """
+
+    def place(self, vif, targets, assigned, index):
+        def weight(target):
+            key = '%s:%s' % (vif['id'], target.uuid)
+            return hashlib.md5(key.encode('utf-8')).hexdigest()
+        return max(targets, key=weight)
+
+
+PLACEMENTS = {
+    'round_robin': RoundRobinPlacement,
+    'physnet': PhysnetPlacement,
+    'sticky': StickyPlacement,
+}
+
+
+def get_placement(name):
+    return PLACEMENTS[name]()